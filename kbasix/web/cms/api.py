@@ -0,0 +1,245 @@
+"""
+The JSON API module for the KBasix CMS.
+Created by: Pamela Brittain
+            James Colliander
+            Marco De la Cruz-Heredia
+            Emile LeBlanc
+Coded by: Marco De la Cruz-Heredia (marco@math.utoronto.ca)
+
+Copyright (c) 2012, Department of Mathematics, University of Toronto
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice,
+   this list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+POSSIBILITY OF SUCH DAMAGE.
+"""
+
+_VERSION = 0.10
+
+class ListFilesError(Exception): pass
+
+
+"""
+The API answers the same questions as the file manager and metadata
+editor pages, but with JSON instead of HTML, for use by scripts (no
+templates are filled in). The session token is passed as usual, and a
+new one is returned with every reply (see 'per_request_token'). All
+replies are JSON objects, and failures set the HTTP status and an
+'error' string.
+"""
+
+
+def _reply(req, info, reply, status=None):
+    """Reply with a JSON object.
+
+       return _reply(req, info, reply, status=None)
+
+    The 'status' is the HTTP status code (if not 200). Returns a string.
+    """
+    import json
+    if status:
+        req.status = status
+    reply['token'] = info['token']
+    req.content_type = 'application/json'
+    return json.dumps(reply, separators=(',', ':'))
+
+
+def _error(req, info, status, details):
+    """Reply with an error.
+
+       return _error(req, info, status, details)
+
+    Returns a string.
+    """
+    return _reply(req, info, {'error': details}, status)
+
+
+def _meta_reply(file_meta, info):
+    """Turn the metadata of a file into (part of) a reply.
+
+       meta = _meta_reply(file_meta, info)
+
+    Who else a file is shared with is only told to its owner (as in the
+    file manager page, see also '_file_shares'). Returns a dictionary.
+    """
+    meta = dict(file_meta.items())
+    if file_meta['owner_uid'] != info['uid']:
+        for key in ['uid_shares', 'gid_shares', 'local_share', \
+                        'world_share']:
+            meta.pop(key, None)
+    return meta
+
+
+def _list_files(req, info):
+    """List the files the user can see, a page at a time.
+
+       return _list_files(req, info)
+
+    Takes the same view options as the file manager ('sort_criteria',
+    'then_sort_criteria', 'reverse', 'hide_shared' and 'keywords'),
+    but these are not stored in the user's preferences. The page
+    ('page', counting from 0) holds 'per_page' entries, at most
+    'max_entries_per_page'. Returns a string.
+    """
+    import manage_kbasix
+    import file_manager
+    prefs = manage_kbasix._account_info(info['login_name'], 'prefs')
+    if 'file_manager' in prefs:
+        hidden = prefs['file_manager']['hidden_gidloc_shared_files']
+    else:
+        hidden = []
+    options = {'hidden_gidloc_shared_files': hidden}
+    for key in ['sort_criteria', 'then_sort_criteria', 'reverse', \
+                    'hide_shared', 'keywords']:
+        if key in req.form:
+            options[key] = req.form[key].value.decode('utf-8')
+        else:
+            options[key] = ''
+    criteria = []
+    for key in ['sort_criteria', 'then_sort_criteria']:
+        if not options[key]:
+            continue
+        if options[key] not in info['allowed_sort_criteria']:
+            raise ListFilesError('Invalid sort criteria "%s" (%s)' % \
+                                     (options[key], info['login_name']))
+        criteria.append(options[key])
+    if not criteria:
+        criteria = [info['default_sort_criteria_']]
+    try:
+        page = max(0, int(req.form['page'].value))
+    except:
+        page = 0
+    try:
+        per_page = int(req.form['per_page'].value)
+    except:
+        per_page = info['max_entries_per_page']
+    per_page = min(max(1, per_page), info['max_entries_per_page'])
+    entries = file_manager._get_entries(info, {'file_manager': options})
+    total = len(entries)
+    entries = file_manager._select_entries(entries, criteria, \
+                                               bool(options['reverse']), \
+                                               page, per_page)
+    return _reply(req, info, {'files': [_meta_reply(i, info) \
+                                            for i in entries], \
+                                  'page': page, 'per_page': per_page, \
+                                  'total': total})
+
+
+def _file_meta(req, info):
+    """Give the metadata of a file the user can see.
+
+       return _file_meta(req, info)
+
+    The custom metadata is under 'custom'. Returns a string.
+    """
+    import catalog
+    import file_manager
+    from mod_python import apache
+    file_meta = file_manager._get_file_meta(req.form['file_tag'].value, info)
+    if not file_meta or not file_manager._can_access(file_meta, info):
+        return _error(req, info, apache.HTTP_NOT_FOUND, 'No such file')
+    file_meta['shared_with_me'] = file_meta['owner_uid'] != info['uid']
+    reply = _meta_reply(file_meta, info)
+    the_file = file_manager._file_path(file_meta['file_tag'], info)
+    reply['custom'] = catalog._read_custom(the_file + '-id')
+    return _reply(req, info, reply)
+
+
+def _file_shares(req, info):
+    """Give the shares of a file the user owns.
+
+       return _file_shares(req, info)
+
+    The user and group shares are lists of names, marked as in the
+    metadata editor (see 'metaeditor._get_shares'). Returns a string.
+    """
+    import file_manager
+    import metaeditor
+    from mod_python import apache
+    file_meta = file_manager._get_file_meta(req.form['file_tag'].value, info)
+    if not file_meta or file_meta['owner_uid'] != info['uid']:
+        return _error(req, info, apache.HTTP_NOT_FOUND, 'No such file')
+    (users, groups, local, world) = metaeditor._get_shares(file_meta, info)
+    reply = {'file_tag': file_meta['file_tag'], \
+                 'uid_shares': [i for i in users.split(', ') if i], \
+                 'gid_shares': [i for i in groups.split(', ') if i], \
+                 'local_share': bool(local), 'world_share': bool(world)}
+    return _reply(req, info, reply)
+
+
+def process(req):
+    """Process an API request.
+
+       process(req)
+    """
+    from manage_kbasix import _is_session
+    from defs import kbasix, file_manager, metaeditor, api
+    info = {}
+    info.update(kbasix)
+    info.update(file_manager)
+    info.update(metaeditor)
+    info.update(api)
+    info['token'] = ''
+    import logging
+    logging.basicConfig(level = getattr(logging, \
+                                            info['log_level_'].upper()), \
+                            filename = info['log_file_'], \
+                            datefmt = info['log_dateformat_'], \
+                            format = info['log_format_'])
+    from mod_python import apache
+    import file_manager as fm
+    if repr(type(req)) != "<type 'mp_request'>":
+        logging.critical('Invalid request for api.py')
+        return _error(req, info, apache.HTTP_BAD_REQUEST, 'Invalid request')
+    if not req.is_https():
+        logging.info('Disallowed insecure access to api.py')
+        return _error(req, info, apache.HTTP_FORBIDDEN, 'Insecure connection')
+    # Scripts cannot follow the redirect to the login page, so the
+    # session is not required (and checked below instead).
+    try:
+        session = _is_session(req, required=False)
+    except Exception as reason:
+        logging.warn(reason)
+        session = {}
+    if not session or not session['token']:
+        return _error(req, info, apache.HTTP_FORBIDDEN, 'Invalid session')
+    info.update(session)
+    if 'action' not in req.form:
+        return _error(req, info, apache.HTTP_BAD_REQUEST, 'No action')
+    action = req.form['action']
+    try:
+        if action == 'list':
+            return _list_files(req, info)
+        elif action in ['meta', 'shares'] and 'file_tag' not in req.form:
+            return _error(req, info, apache.HTTP_BAD_REQUEST, 'No file tag')
+        elif action == 'meta':
+            return _file_meta(req, info)
+        elif action == 'shares':
+            return _file_shares(req, info)
+        else:
+            return _error(req, info, apache.HTTP_BAD_REQUEST, \
+                              'Unexpected action')
+    except (ListFilesError, fm.CheckFileTagError) as reason:
+        logging.warn(reason)
+        return _error(req, info, apache.HTTP_BAD_REQUEST, str(reason))
+    except Exception as reason:
+        logging.error(reason)
+        return _error(req, info, apache.HTTP_INTERNAL_SERVER_ERROR, \
+                          'Unable to complete the request')
@@ -71,6 +71,68 @@ def _fill_page(page, keys):
     return _fill_str(data, keys)
 
 
+def _iter_page(page, keys, stream_key, chunks):
+    """Read a page and yield it in pieces, with the strings produced by
+    'chunks' taking the place of '%(stream_key)s'.
+
+       pieces = _iter_page(page, keys, stream_key, chunks)
+
+    The part of the page following 'stream_key' is only filled once
+    'chunks' is exhausted, so values set whilst producing the chunks
+    (e.g. a page navigation) can still be used there.
+    Returns a generator (of strings).
+    """
+    try:
+        data = open(page).read()
+    except Exception as reason:
+        yield '[SYS] Unable to open file: ' + os.path.basename(page)
+        return
+    (head, found, tail) = data.partition('%(' + stream_key + ')s')
+    yield _fill_str(head, keys)
+    if not found:
+        return
+    for chunk in chunks:
+        yield chunk
+    yield _fill_str(tail, keys)
+
+
+def _send_page(req, page, keys, stream_key, chunks):
+    """Write a page to the client as it is produced (see '_iter_page'),
+    instead of building it all in memory first.
+
+       return _send_page(req, page, keys, stream_key, chunks)
+
+    The first chunk is produced before anything is written, so that
+    an error whilst gathering the data (rather than whilst rendering it)
+    can still be reported with a clean error page.
+    Returns an empty string (there is nothing left for the publisher
+    to send).
+    """
+    import itertools
+    chunks = iter(chunks)
+    try:
+        first = [chunks.next()]
+    except StopIteration:
+        first = []
+    req.content_type = 'text/html'
+    # The head of the page is flushed straight away.
+    pending = stream_flush_bytes
+    for piece in _iter_page(page, keys, stream_key, \
+                                itertools.chain(first, chunks)):
+        if isinstance(piece, unicode):
+            piece = piece.encode('utf-8')
+        # Let Apache buffer small pieces, but make sure the client gets
+        # something to work with every 'stream_flush_bytes'.
+        pending += len(piece)
+        if pending >= stream_flush_bytes:
+            req.write(piece)
+            pending = 0
+        else:
+            req.write(piece, 0)
+    req.flush()
+    return ''
+
+
 def _make_header(info):
     """Make the appropriate page header (either for a visitor or a member).
 
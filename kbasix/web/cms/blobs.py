@@ -0,0 +1,181 @@
+"""
+The content-addressed blob store of the KBasix CMS.
+Created by: Pamela Brittain
+            James Colliander
+            Marco De la Cruz-Heredia
+            Emile LeBlanc
+Coded by: Marco De la Cruz-Heredia (marco@math.utoronto.ca)
+
+Copyright (c) 2012, Department of Mathematics, University of Toronto
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice,
+   this list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+POSSIBILITY OF SUCH DAMAGE.
+"""
+
+_VERSION = 0.10
+
+import os
+import errno
+from defs import kbasix
+
+
+class StoreError(Exception): pass
+class UnrefError(Exception): pass
+class CollectError(Exception): pass
+
+
+for key in kbasix:
+    vars()[key] = kbasix[key]
+
+
+"""
+With 'blob_store' on, the content of each file is kept once however
+many files have it. A blob is named after the SHA-256 digest of its
+content, under 'blobs_dir_', and every -file with that content is a
+hard link to it (so 'blobs_dir_' must be on the same filesystem as
+'users_root_dir_'). The link count of a blob is its reference count:
+a blob linked from nowhere else (a count of 1) is no longer used, and
+is removed (see '_unref' and '_collect'). Since the -file paths stay
+the same nothing reading them (downloads, shares, the quota, which is
+still charged per user) needs to know about blobs, and copying a file
+is just another link. Files are never changed in place, so sharing
+their content is safe. Files added before the blob store was turned on
+(or without a SHA-256 digest) are left as they are.
+"""
+
+
+def _blob_path(sha256):
+    """Find the blob of a digest.
+
+       blob = _blob_path(sha256)
+
+    The blobs are spread over subdirectories named after the first two
+    digits. Returns a string (full path).
+    """
+    return os.path.join(blobs_dir_, sha256[:2], sha256)
+
+
+def _store(file_out, sha256):
+    """Put a file just added into the blob store.
+
+       _store(file_out, sha256)
+
+    If there is a blob with the same content already the file becomes a
+    link to it (freeing its own copy), otherwise the file becomes the
+    blob. Returns nothing.
+    """
+    blob = _blob_path(sha256)
+    try:
+        if not os.path.isdir(os.path.dirname(blob)):
+            try:
+                os.makedirs(os.path.dirname(blob), 0700)
+            except OSError:
+                # Another process got there first.
+                pass
+        # The blob may be collected in between, hence the second try.
+        for attempt in range(2):
+            try:
+                os.link(file_out, blob)
+                return
+            except OSError as reason:
+                if reason.errno != errno.EEXIST:
+                    raise
+            file_stat = os.stat(file_out)
+            blob_stat = os.stat(blob)
+            if os.path.samestat(file_stat, blob_stat) or \
+                    file_stat.st_size != blob_stat.st_size:
+                return
+            # The rename swaps the copy for the link in one go.
+            tmp_file = file_out + '-blob'
+            try:
+                os.link(blob, tmp_file)
+            except OSError as reason:
+                if reason.errno != errno.ENOENT:
+                    raise
+                continue
+            os.rename(tmp_file, file_out)
+            return
+    except Exception as reason:
+        raise StoreError('Unable to store "%s" as blob "%s" because "%s"' % \
+                             (file_out, blob, reason))
+
+
+def _link(src_file, sha256, dst_file):
+    """Add a file with the content of another, without copying it.
+
+       _link(src_file, sha256, dst_file)
+
+    The 'sha256' is the digest of the source (from its metadata), which
+    is put into the blob store first if it wasn't already. Returns
+    nothing.
+    """
+    src_file = os.path.realpath(src_file)
+    _store(src_file, sha256)
+    try:
+        os.link(_blob_path(sha256), dst_file)
+    except OSError as reason:
+        # Collected in between, which can only mean the source is gone.
+        raise StoreError('Unable to link "%s" to "%s" because "%s"' % \
+                             (dst_file, src_file, reason))
+    return
+
+
+def _unref(sha256):
+    """Remove a blob if no file links to it any more.
+
+       _unref(sha256)
+
+    Returns nothing.
+    """
+    blob = _blob_path(sha256)
+    try:
+        if os.stat(blob).st_nlink == 1:
+            os.remove(blob)
+    except OSError as reason:
+        if reason.errno != errno.ENOENT:
+            raise UnrefError(reason)
+    return
+
+
+def _collect():
+    """Remove all the blobs no file links to any more (e.g. after a user
+    directory is wiped).
+
+       freed = _collect()
+
+    Returns an int (the number of blobs removed).
+    """
+    import logging
+    freed = 0
+    if not os.path.isdir(blobs_dir_):
+        return freed
+    try:
+        for sub_dir in os.listdir(blobs_dir_):
+            for sha256 in os.listdir(os.path.join(blobs_dir_, sub_dir)):
+                blob = os.path.join(blobs_dir_, sub_dir, sha256)
+                if os.stat(blob).st_nlink == 1:
+                    os.remove(blob)
+                    freed += 1
+    except Exception as reason:
+        raise CollectError(reason)
+    logging.info('Removed %s unused blobs' % freed)
+    return freed
@@ -0,0 +1,558 @@
+"""
+The file catalog of the KBasix CMS.
+Created by: Pamela Brittain
+            James Colliander
+            Marco De la Cruz-Heredia
+            Emile LeBlanc
+Coded by: Marco De la Cruz-Heredia (marco@math.utoronto.ca)
+
+Copyright (c) 2012, Department of Mathematics, University of Toronto
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice,
+   this list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+POSSIBILITY OF SUCH DAMAGE.
+"""
+
+_VERSION = 0.10
+
+import os
+from manage_users import _read_file, _save_file, _padlock
+from defs import kbasix
+
+
+class VersionError(Exception): pass
+class BumpError(Exception): pass
+class SplitCustomError(Exception): pass
+class ChangesError(Exception): pass
+class UsageError(Exception): pass
+class ReserveError(Exception): pass
+class ReleaseError(Exception): pass
+class TouchError(Exception): pass
+class DigestError(Exception): pass
+
+
+for key in kbasix:
+    vars()[key] = kbasix[key]
+
+
+"""
+The catalog keeps track of what changes in the file listings. Each
+user has a version number which is bumped whenever a file in their
+listing is added, removed or modified. Changes to shared files (which
+show up in the listings of other users) bump the 'shared' version
+instead, so that sharing with every registered user doesn't require
+bumping every user. Each bump is also logged, as [version, file_tag,
+kind] entries, so that the changes since a given version can be
+found (see '_changes'). A 'reset' kind means the changes cannot be
+told apart, e.g. when a user account is deleted.
+
+The catalog of a user also holds their space usage ('usage', the total
+size of the content files they own), which is adjusted by each bump
+instead of summing up the user's directory every time the quota is
+checked (see '_usage'). Files being uploaded or copied first reserve
+their space ('reserved'), so that concurrent uploads cannot together go
+over quota (see '_reserve').
+"""
+
+
+# The fixed metadata fields of a file, as written by 'upload._get_file'.
+_meta_fields = ('owner', 'owner_uid', 'uid_shares', 'gid_shares', \
+                    'local_share', 'world_share', 'timestamp', \
+                    'file_title', 'file_description', 'file_type', \
+                    'file_name', 'file_md5sum', 'file_size', 'file_tag', \
+                    'magic_type', 'file_sha256sum')
+
+
+class FileMeta(object):
+    """The fixed metadata of a file (see '_meta_fields').
+
+       meta = FileMeta(data)
+
+    File listings can hold thousands of these, so they are slotted
+    rather than free-form dictionaries. The custom metadata is left out
+    (only the metadata editor needs it). The fields can be accessed
+    either as attributes or by key, like the metadata dictionaries, and
+    'shared_with_me' is set by the file manager.
+    """
+    __slots__ = _meta_fields + ('shared_with_me',)
+
+    def __init__(self, data):
+        for key in _meta_fields:
+            setattr(self, key, data.get(key))
+        self.shared_with_me = False
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        try:
+            setattr(self, key, value)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return key in self.__slots__
+
+    def items(self):
+        return [(key, getattr(self, key)) for key in self.__slots__]
+
+
+def _read_meta(id_file):
+    """Read the fixed metadata of a file.
+
+       meta = _read_meta(id_file)
+
+    Returns a FileMeta.
+    """
+    return FileMeta(_read_file(id_file, lock=False))
+
+
+def _custom_file(id_file):
+    """Find the custom metadata file belonging to a metadata file.
+
+       custom_file = _custom_file(id_file)
+
+    Returns a string (full path).
+    """
+    # The magic [:-3] deletes '-id'.
+    return id_file[:-3] + '-custom'
+
+
+def _split_custom(id_file):
+    """Move the custom metadata out of a metadata file.
+
+       split = _split_custom(id_file)
+
+    Custom metadata is kept in its own file (see '_custom_file') so that
+    the file listings, which only need the fixed fields, never have to
+    parse it. Earlier versions kept it within the metadata file under
+    the 'custom' key. Returns a boolean (True if there was anything to
+    move).
+    """
+    try:
+        _padlock(id_file, 'lock')
+        data = _read_file(id_file, lock=False)
+        if 'custom' not in data:
+            _padlock(id_file, 'unlock')
+            return False
+        custom_file = _custom_file(id_file)
+        if data['custom'] and not os.path.isfile(custom_file):
+            _save_file(data['custom'], custom_file, unlock=False, \
+                           backup=False)
+        del data['custom']
+        _save_file(data, id_file, backup=False)
+    except Exception as reason:
+        _padlock(id_file, 'unlock')
+        raise SplitCustomError(reason)
+    return True
+
+
+def _read_custom(id_file):
+    """Read the custom metadata of a file.
+
+       custom = _read_custom(id_file)
+
+    Metadata files from earlier versions are split first (see
+    '_split_custom'). Returns a dictionary (an empty one if there is no
+    custom metadata).
+    """
+    _split_custom(id_file)
+    custom_file = _custom_file(id_file)
+    if not os.path.isfile(custom_file):
+        return {}
+    return _read_file(custom_file, lock=False)
+
+
+def _save_custom(custom, id_file):
+    """Save the custom metadata of a file.
+
+       _save_custom(custom, id_file)
+
+    Returns nothing.
+    """
+    _save_file(custom, _custom_file(id_file), unlock=False, backup=False)
+    return
+
+
+def _catalog_file(scope):
+    """Find the catalog file of a scope.
+
+       catalog_file = _catalog_file(scope)
+
+    The 'scope' is either a uid or 'shared'. Returns a string (full
+    path).
+    """
+    if scope == 'shared':
+        return os.path.join(shared_dir_, 'shared.catalog')
+    return os.path.join(users_root_dir_, str(scope), '%s.catalog' % scope)
+
+
+def _version(scope):
+    """Retrieve the current catalog version of a scope.
+
+       version = _version(scope)
+
+    The 'scope' is either a uid or 'shared'. Returns an int (0 if
+    nothing has been recorded yet).
+    """
+    catalog_file = _catalog_file(scope)
+    if not os.path.isfile(catalog_file):
+        return 0
+    try:
+        return _read_file(catalog_file, lock=False)['version']
+    except Exception as reason:
+        raise VersionError(reason)
+
+
+def _bump(scope, file_tags=[], kind='modified', usage=0, reservation=''):
+    """Bump the catalog version of a scope.
+
+       version = _bump(scope, file_tags=[], kind='modified', usage=0,
+                       reservation='')
+
+    The 'scope' is either a uid or 'shared'. The 'file_tags' (a list)
+    are logged with the new version as being 'added', 'removed' or
+    'modified' (the 'kind'), or 'reset' (which needs no file tags).
+    At most 'catalog_log_entries' are kept. The 'usage' is the change in
+    the user's space usage in bytes (see '_usage'), and the
+    'reservation' (if any) that space was taken from is released (see
+    '_reserve'). Returns the new version (an int).
+    """
+    catalog_file = _catalog_file(scope)
+    try:
+        # The lock is taken before checking for the file so that
+        # concurrent first-time bumps do not race.
+        _padlock(catalog_file, 'lock')
+        if os.path.isfile(catalog_file):
+            catalog = _read_file(catalog_file, lock=False)
+        else:
+            catalog = {'version': 0}
+        # Earlier versions did not log the changes, so those versions
+        # cannot be caught up with.
+        if 'log' not in catalog:
+            catalog['log'] = []
+            catalog['oldest'] = catalog['version']
+        catalog['version'] += 1
+        # A usage which was never counted is left for '_usage'.
+        if usage and 'usage' in catalog:
+            catalog['usage'] = max(0, catalog['usage'] + usage)
+        if reservation and 'reserved' in catalog:
+            catalog['reserved'].pop(reservation, None)
+        if kind == 'reset':
+            catalog['log'].append([catalog['version'], None, kind])
+        for file_tag in file_tags:
+            catalog['log'].append([catalog['version'], file_tag, kind])
+        # The log is trimmed from the front, and the changes up to
+        # 'oldest' are those which are no longer known.
+        excess = len(catalog['log']) - catalog_log_entries
+        if excess > 0:
+            catalog['oldest'] = catalog['log'][excess - 1][0]
+            del catalog['log'][:excess]
+        # These files are rewritten all the time, so no backups.
+        _save_file(catalog, catalog_file, backup=False)
+    except Exception as reason:
+        _padlock(catalog_file, 'unlock')
+        raise BumpError(reason)
+    return catalog['version']
+
+
+def _changes(scope, since):
+    """Find the changes made to a scope after a given version.
+
+       (version, changes) = _changes(scope, since)
+
+    The 'scope' is either a uid or 'shared', and 'since' an int
+    version. Returns an (int, list) tuple with the current version and
+    the logged [version, file_tag, kind] entries (see '_bump') newer
+    than 'since'. The list is None if those changes are not all known
+    (they are too old, 'since' is in the future, or there was a reset).
+    """
+    catalog_file = _catalog_file(scope)
+    if not os.path.isfile(catalog_file):
+        catalog = {'version': 0, 'log': [], 'oldest': 0}
+    else:
+        try:
+            catalog = _read_file(catalog_file, lock=False)
+        except Exception as reason:
+            raise ChangesError(reason)
+    if 'log' not in catalog:
+        return (catalog['version'], None)
+    if since < catalog['oldest'] or since > catalog['version']:
+        return (catalog['version'], None)
+    changes = [i for i in catalog['log'] if i[0] > since]
+    if [i for i in changes if i[2] == 'reset']:
+        return (catalog['version'], None)
+    return (catalog['version'], changes)
+
+
+def _usage(uid):
+    """Retrieve the space usage of a user.
+
+       usage = _usage(uid)
+
+    The usage is counted (see '_count_usage') the first time it is
+    needed. Returns an int (bytes).
+    """
+    catalog_file = _catalog_file(uid)
+    if os.path.isfile(catalog_file):
+        try:
+            catalog = _read_file(catalog_file, lock=False)
+        except Exception as reason:
+            raise UsageError(reason)
+        if 'usage' in catalog:
+            return catalog['usage']
+    return _count_usage(uid)
+
+
+def _count_usage(uid):
+    """Count the space usage of a user from scratch, and store it.
+
+       usage = _count_usage(uid)
+
+    This walks the user's directory, so it is only done the first time
+    (see '_usage') and to correct any drift (e.g. at login, or after
+    files were removed by hand). Returns an int (bytes).
+    """
+    import aux
+    catalog_file = _catalog_file(uid)
+    try:
+        # Bumps wait for the count, so none are lost.
+        _padlock(catalog_file, 'lock')
+        if os.path.isfile(catalog_file):
+            catalog = _read_file(catalog_file, lock=False)
+        else:
+            catalog = {'version': 0}
+        catalog['usage'] = aux._get_dir_size({'users_root_dir_': \
+                                                  users_root_dir_, \
+                                                  'uid': uid})
+        _save_file(catalog, catalog_file, backup=False)
+    except Exception as reason:
+        _padlock(catalog_file, 'unlock')
+        raise UsageError(reason)
+    return catalog['usage']
+
+
+def _reserve(uid, size, quota):
+    """Reserve space within a user's quota for a file being added.
+
+       (reservation, size) = _reserve(uid, size, quota)
+
+    The 'size' is in bytes, or None to reserve all the space left. The
+    space left is the 'quota' minus the usage (see '_usage') and the
+    reservations of other uploads and copies in progress. Reservations
+    are released by '_bump' (once the file is added) or '_release', and
+    those unused for 'quota_reservation_timeout' (left over by a crashed
+    upload, see '_touch') are dropped. Returns a (str, int) tuple with
+    the reservation and its size or, if there isn't enough space, an
+    empty string and the space left (which may be negative).
+    """
+    import time
+    import aux
+    catalog_file = _catalog_file(uid)
+    try:
+        _padlock(catalog_file, 'lock')
+        if os.path.isfile(catalog_file):
+            catalog = _read_file(catalog_file, lock=False)
+        else:
+            catalog = {'version': 0}
+        if 'usage' not in catalog:
+            catalog['usage'] = aux._get_dir_size({'users_root_dir_': \
+                                                      users_root_dir_, \
+                                                      'uid': uid})
+        now = time.time()
+        reserved = catalog.get('reserved', {})
+        for i in reserved.keys():
+            if now - reserved[i][1] >= quota_reservation_timeout:
+                del reserved[i]
+        left = quota - catalog['usage'] - \
+            sum([reserved[i][0] for i in reserved])
+        if size is None:
+            size = max(0, left)
+        if size > left or left <= 0:
+            _save_file(catalog, catalog_file, backup=False)
+            return ('', left)
+        reservation = '%r-%s' % (now, os.getpid())
+        reserved[reservation] = [size, now]
+        catalog['reserved'] = reserved
+        _save_file(catalog, catalog_file, backup=False)
+    except Exception as reason:
+        _padlock(catalog_file, 'unlock')
+        raise ReserveError(reason)
+    return (reservation, size)
+
+
+def _touch(uid, reservation):
+    """Keep a reservation in use from expiring (see '_reserve'), e.g.
+    while a chunked upload goes on.
+
+       kept = _touch(uid, reservation)
+
+    The catalog is only rewritten once the reservation is a tenth of
+    'quota_reservation_timeout' old, not on every call. Returns a
+    boolean (False if the reservation has already expired).
+    """
+    import time
+    catalog_file = _catalog_file(uid)
+    if not os.path.isfile(catalog_file):
+        return False
+    try:
+        reserved = _read_file(catalog_file, lock=False).get('reserved', {})
+        if reservation not in reserved:
+            return False
+        if time.time() - reserved[reservation][1] < \
+                quota_reservation_timeout / 10.0:
+            return True
+        _padlock(catalog_file, 'lock')
+        catalog = _read_file(catalog_file, lock=False)
+        reserved = catalog.get('reserved', {})
+        kept = reservation in reserved
+        if kept:
+            reserved[reservation][1] = time.time()
+        _save_file(catalog, catalog_file, backup=False)
+    except Exception as reason:
+        _padlock(catalog_file, 'unlock')
+        raise TouchError(reason)
+    return kept
+
+
+def _release(uid, reservation):
+    """Release a reservation of space which is no longer needed (e.g.
+    the upload failed).
+
+       _release(uid, reservation)
+
+    Returns nothing.
+    """
+    catalog_file = _catalog_file(uid)
+    if not reservation or not os.path.isfile(catalog_file):
+        return
+    try:
+        _padlock(catalog_file, 'lock')
+        catalog = _read_file(catalog_file, lock=False)
+        if 'reserved' in catalog:
+            catalog['reserved'].pop(reservation, None)
+        _save_file(catalog, catalog_file, backup=False)
+    except Exception as reason:
+        _padlock(catalog_file, 'unlock')
+        raise ReleaseError(reason)
+    return
+
+
+"""
+When uploads are deduplicated (see 'upload._upload_by_hash') the
+content of the files is also indexed by its SHA-256 digest, so that a
+file can be found by its content without going through the metadata of
+every user. Each digest has a small file under 'digests_dir_' listing
+the [uid, file_tag] of the files with that content. Entries are not
+removed when files are deleted: stale ones are dropped the next time the
+digest is looked up.
+"""
+
+
+def _digest_file(sha256):
+    """Find the index file of a digest.
+
+       digest_file = _digest_file(sha256)
+
+    The index is spread over subdirectories named after the first two
+    digits. Raises DigestError if 'sha256' isn't a SHA-256 hex digest.
+    Returns a string (full path).
+    """
+    import string
+    sha256 = str(sha256).lower()
+    if len(sha256) != 64 or sha256.strip(string.hexdigits):
+        raise DigestError('Invalid SHA-256 digest "%s"' % sha256)
+    return os.path.join(digests_dir_, sha256[:2], sha256)
+
+
+def _index_digest(sha256, uid, file_tag):
+    """Record that a file has the given content.
+
+       _index_digest(sha256, uid, file_tag)
+
+    Returns nothing.
+    """
+    digest_file = _digest_file(sha256)
+    try:
+        if not os.path.isdir(os.path.dirname(digest_file)):
+            os.makedirs(os.path.dirname(digest_file), 0700)
+    except OSError:
+        # Another process got there first.
+        pass
+    try:
+        _padlock(digest_file, 'lock')
+        if os.path.isfile(digest_file):
+            entries = _read_file(digest_file, lock=False)
+        else:
+            entries = []
+        if [uid, file_tag] not in entries:
+            entries.append([uid, file_tag])
+        _save_file(entries, digest_file, backup=False)
+    except Exception as reason:
+        _padlock(digest_file, 'unlock')
+        raise DigestError(reason)
+    return
+
+
+def _find_digest(sha256):
+    """Find the files with the given content.
+
+       entries = _find_digest(sha256)
+
+    The files may have been deleted since (see '_unindex_digest').
+    Returns a list of [uid, file_tag] entries.
+    """
+    digest_file = _digest_file(sha256)
+    if not os.path.isfile(digest_file):
+        return []
+    try:
+        return _read_file(digest_file, lock=False)
+    except Exception as reason:
+        raise DigestError(reason)
+
+
+def _unindex_digest(sha256, uid, file_tag):
+    """Drop a (deleted) file from the index of a digest.
+
+       _unindex_digest(sha256, uid, file_tag)
+
+    Returns nothing.
+    """
+    digest_file = _digest_file(sha256)
+    if not os.path.isfile(digest_file):
+        return
+    try:
+        _padlock(digest_file, 'lock')
+        entries = _read_file(digest_file, lock=False)
+        if [uid, file_tag] in entries:
+            entries.remove([uid, file_tag])
+        if entries:
+            _save_file(entries, digest_file, backup=False)
+        else:
+            os.remove(digest_file)
+            _padlock(digest_file, 'unlock')
+    except Exception as reason:
+        _padlock(digest_file, 'unlock')
+        raise DigestError(reason)
+    return
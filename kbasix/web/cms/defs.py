@@ -112,6 +112,24 @@ kbasix['groups_file_'] = kbasix_root_ + '/sys/groups.json'
 kbasix['users_root_dir_'] = kbasix_root_ + '/files'
 kbasix['shared_dir_'] = kbasix_root_ + '/files/shared'
 
+# Keep the content of identical files only once, in 'blobs_dir_' (see
+# blobs.py), which must be on the same filesystem as 'users_root_dir_'
+# (and, like 'shared_dir_', contain a non-numeric character).
+kbasix['blob_store'] = False
+kbasix['blobs_dir_'] = kbasix_root_ + '/files/blobs'
+
+# Where uploads are spooled to (see upload_guard.py), which must be on the
+# same filesystem as 'users_root_dir_' and not within a user directory.
+kbasix['spool_dir_'] = kbasix_root_ + '/files/.spool'
+
+# Index of the file contents by digest, used when 'dedup' is True (see
+# upload.py).
+kbasix['digests_dir_'] = kbasix_root_ + '/sys/digests'
+
+# Queue of the background jobs (see jobs.py), which should also be outside
+# 'DocumentRoot'.
+kbasix['jobs_dir_'] = kbasix_root_ + '/sys/jobs'
+
 # This directory must exist and be located somewhere under 'DocumentRoot'.
 kbasix['www_dir_'] = kbasix_root_ + '/web/users'
 
@@ -306,10 +324,29 @@ kbasix['log_dateformat_'] = '%a, %d %b %Y %H:%M:%S'
 kbasix['log_format_'] = \
     '%(levelname)-8s : %(asctime)s : %(filename)s : %(funcName)s : %(lineno)s : %(message)s'
 
+# Long pages (e.g. the file manager listing) are written to the client
+# as they are rendered. Output is flushed to the client every this many
+# bytes (Apache buffers whatever is written in between).
+kbasix['stream_flush_bytes'] = 64*1024
+
+# Number of changes to the file listings kept per user (and for the shared
+# files), see 'changes' in file_manager.py. Clients which fall further
+# behind get a full listing instead.
+kbasix['catalog_log_entries'] = 1000
+
+# Space reserved for uploads and copies in progress is let go after this
+# many seconds (in case the upload died without releasing it). It should
+# be longer than the slowest upload.
+kbasix['quota_reservation_timeout'] = 6*3600
+
 # Blurb on reaching quota limit.
 # Extra: %(user_dir_size)s
 kbasix['quota_limit_blurb'] = \
     'Quota limit reached (using %(user_dir_size)s out of %(quota)s bytes), you cannot add any more files.'
+# Blurb on a file not fitting in the quota left.
+# Extra: %(user_dir_size)s
+kbasix['quota_fit_blurb'] = \
+    'There is not enough quota left for this file (using %(user_dir_size)s out of %(quota)s bytes).'
 
 
 ## MAIN PAGE
@@ -443,9 +480,50 @@ upload['file_types'] = ['audio', 'video', 'image', 'document', 'archive', \
 # in the .htaccess file, this is just informative (see upload.py for
 # details).
 upload['size_limit_'] = '8MB'
+# Size of the buffer files are read and written with when uploading and
+# copying (in bytes).
+upload['chunk_size'] = 2**16
+# Digests (as named by hashlib) stored in the file metadata as e.g.
+# "file_sha256sum". The MD5 is always kept.
+upload['digests'] = ['md5', 'sha256']
+# Hash on a separate thread, overlapping with the disk writes (worth it on
+# multi-core servers with large uploads).
+upload['threaded_hashing'] = False
+# Bytes of an upload request which are not the file itself (the multipart
+# headers and the other fields). A request up to this much larger than the
+# quota left is still let through, since the file may fit.
+upload['form_overhead'] = 16*1024
+# Have mod_python spool uploaded files into 'spool_dir_' (hashing them as
+# they arrive), so that they are put in place with a rename rather than
+# copied from /tmp (see upload_guard.py).
+upload['spool_uploads'] = True
+# Tasks (see jobs.py) queued for each file uploaded, run in the background
+# by the jobs.py worker instead of while the user waits. E.g. with
+# ['magic_type'] the file type is worked out by the worker (the file shows
+# "Pending" until then). Leave empty if no worker is running.
+upload['post_upload_tasks'] = []
+# Let clients skip sending a file whose content is already on the server
+# (the "upload_by_hash" action in upload.py), linking to it instead. Only
+# content the user can already read is matched, and files are indexed
+# from the moment this is turned on.
+upload['dedup'] = False
+# Most files a single upload may add (several files sent at once, or the
+# members of the archives expanded).
+upload['upload_max_files'] = 1000
+# Largest chunk accepted by chunked uploads (see upload.py), which must
+# be well under "LimitRequestBody" in .htaccess. The files themselves are
+# only limited by the quota.
+upload['max_chunk_size'] = 4*1024*1024
 # Allowed: %(name)s, %(type)s, %(size)s, %(md5)s
 upload['successful_upload_'] = \
     'File "%(name)s" uploaded successfully<br>(type: %(type)s | size: %(size)s | md5sum: %(md5)s)'
+# Allowed: %(count)s, %(size)s
+upload['successful_files_'] = \
+    '%(count)s files uploaded successfully (total size: %(size)s):'
+# One per file uploaded along with others.
+# Allowed: %(name)s, %(type)s, %(size)s, %(md5)s
+upload['successful_files_item_'] = \
+    '"%(name)s" (type: %(type)s | size: %(size)s | md5sum: %(md5)s)'
 
 
 ## FILE MANAGER PAGE
@@ -468,6 +546,13 @@ file_manager['empty_placeholder_'] = ''
 # Set whether files shared by a deleted (but not wiped) user remain visible
 # to sharees.
 file_manager['exusers_cannot_share'] = True
+# Copy files within KBasix as reflinks (sharing the data blocks until
+# either file is changed) on filesystems which support them, e.g. btrfs or
+# XFS, falling back to a real copy otherwise. Each copy is counted, by how
+# it was made ("linked" by the blob store, "cloned" or "copied"), in
+# 'copy_stats_file_'.
+file_manager['reflink_copies'] = True
+file_manager['copy_stats_file_'] = kbasix_root_ + '/sys/copy_stats.json'
 file_manager['allowed_sort_criteria'] = ['timestamp', 'file_title', \
                                              'file_description', \
                                              'file_type', \
@@ -475,6 +560,16 @@ file_manager['allowed_sort_criteria'] = ['timestamp', 'file_title', \
                                              'file_date']
 file_manager['default_sort_criteria_'] = \
     file_manager['allowed_sort_criteria'][0]
+# Number of entries shown per page of the file manager. Make '0' for
+# unlimited (all entries in one page).
+file_manager['entries_per_page'] = 0
+# Rendered file listings are cached in memory (per Apache child) so that
+# they need not be re-rendered until the files, or the way they are
+# viewed, change. At most 'list_cache_entries' listings totalling
+# 'list_cache_bytes' are kept (the least recently used are dropped). Make
+# 'list_cache_entries' '0' to disable the cache.
+file_manager['list_cache_entries'] = 64
+file_manager['list_cache_bytes'] = 16*1024*1024
 # Formatting of the icons in the file manager.
 # Allowed: file metadata, %(token)s, %(file_date)s, %(shared_status)s,
 # %(shared_with_me)s
@@ -527,10 +622,11 @@ file_manager['shared_icon_by_me_to_groups_'] = \
     '/cms/shared_by_me_to_groups.png'
 file_manager['shared_icon_by_me_to_world_'] = \
     '/cms/shared_by_me_to_world.png'
-# Format for each entry in the file manager (normal and condensed views).
+# Format for each entry in the file manager (normal and condensed views),
+# without the icons (which are added below).
 # Allowed: file metadata, %(file_size_str)s, %(token)s, %(file_date)s,
 # %(shared_status)s, %(title_blurb)s, %(description_blurb)s
-file_manager['entry_template_'] = """
+file_manager['entry_text_'] = """
       <tr>
         <td class="text">
           <p class="file_title" style="color: %(file_colour)s;">%(shared_status)s %(title_blurb)s</p>
@@ -538,14 +634,59 @@ file_manager['entry_template_'] = """
           <p class="file_date">Uploaded: %(file_size_str)s on %(file_date)s</p>
           <p class="description">%(description_blurb)s</p>
         </td>
-""" + file_manager['entry_icons_']
-# Allowed: same as 'entry_template_'
-file_manager['condensed_entry_template_'] = """
+"""
+# Allowed: same as 'entry_text_'
+file_manager['condensed_entry_text_'] = """
       <tr>
         <td class="text">
           <p class="condensed_entry">%(copy_file)s %(shared_status)s <font style="color: %(file_colour)s; font-weight: bold;">%(file_name)s</font> (%(file_size_str)s)</p>
         </td>
-""" + file_manager['entry_icons_']
+"""
+file_manager['entry_template_'] = \
+    file_manager['entry_text_'] + file_manager['entry_icons_']
+file_manager['condensed_entry_template_'] = \
+    file_manager['condensed_entry_text_'] + file_manager['entry_icons_']
+# In the compact listing the entries have buttons instead of forms, all
+# of them submitting through the one "files" form of the page (which holds
+# the token). This roughly halves the size of each entry.
+file_manager['compact_listing'] = True
+# Allowed: same as 'entry_icons_'
+file_manager['compact_entry_icons_'] = """
+        <td class="icon"><button form="files" formaction="process?action=confirm_delete" name="file_tag" value="%(file_tag)s" title="Delete"><img src="/cms/delete.png" alt="Delete"></button></td>
+        <td class="icon"><button form="files" formaction="process?action=download" name="file_tag" value="%(file_tag)s" title="Download"><img src="/cms/download.png" alt="Download"></button></td>
+        <td class="icon"><button form="files" formaction="../metaeditor.py/process?start" name="file_tag" value="%(file_tag)s" title="Edit Properties"><img src="/cms/edit.png" alt="Edit Properties"></button></td>
+        <td class="icon"><input %(toggle_select)s form="bulk_delete" type="checkbox" name="bulk" value="%(file_tag)s"></td>
+      </tr>
+"""
+file_manager['compact_entry_template_'] = \
+    file_manager['entry_text_'] + file_manager['compact_entry_icons_']
+file_manager['compact_condensed_entry_template_'] = \
+    file_manager['condensed_entry_text_'] + \
+    file_manager['compact_entry_icons_']
+
+
+## JSON API
+## --------
+
+api = {}
+# Largest page of file listing entries given by 'api.py' (which is also
+# the default page size).
+api['max_entries_per_page'] = 1000
+
+
+## BACKGROUND JOBS
+## ---------------
+
+jobs = {}
+# Seconds a worker waits before looking for new jobs when the queue is
+# empty.
+jobs['poll_interval'] = 2
+# Times a job is tried before it is moved to "failed" under 'jobs_dir_'.
+jobs['max_attempts'] = 3
+# Seconds before a failed job is tried again, doubled with every attempt.
+jobs['retry_delay'] = 60
+# Seconds between looks for jobs claimed by workers which died.
+jobs['recover_interval'] = 300
 
 
 ## METADATA EDITOR PAGE
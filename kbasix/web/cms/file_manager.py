@@ -49,10 +49,9 @@ def _initialize(req, info):
     import logging
     import aux
     import cgi
+    import catalog
     import manage_kbasix
     logging.debug('Starting the file manager (%s)' % info['login_name'])
-    info['user_dir_size'] = aux._bytes_string(aux._get_dir_size(info))
-    info['quota'] = aux._bytes_string(info['quota'])
     # Check to see if the files have been bulk-selected.
     if 'toggle_select' in req.form and \
             req.form['toggle_select'].value == 'checked':
@@ -73,6 +72,9 @@ def _initialize(req, info):
         prefs['file_manager']['hide_shared'] = ''
         prefs['file_manager']['condensed_view'] = ''
         prefs['file_manager']['keywords'] = ''
+    # Settings added after the first-time preferences were stored.
+    if 'then_sort_criteria' not in prefs['file_manager']:
+        prefs['file_manager']['then_sort_criteria'] = ''
     # Update the settings if filtering has been requested.
     for key in prefs['file_manager']:
         if not info['filter']:
@@ -106,19 +108,132 @@ def _initialize(req, info):
     if not prefs['file_manager']['sort_criteria']:
         prefs['file_manager']['sort_criteria'] = \
             info['default_sort_criteria_']
-    info['sort_criteria_list'] = '\n'
-    # Create the sort criteria drop.
-    for i in info['allowed_sort_criteria']:
-        s = ''
-        if i == prefs['file_manager']['sort_criteria']:
-            s = 'selected'
-        info['sort_criteria_list'] += \
-            '<option %s value="%s">%s</option>\n' % \
-            (s, i, i.split('_')[-1].capitalize())
+    # The page of the listing being shown (counting from 0).
+    try:
+        info['page'] = max(0, int(req.form['page'].value))
+    except:
+        info['page'] = 0
     manage_kbasix._account_mod(info['login_name'], 'prefs', prefs)
-    info['file_list'] = _get_file_list(info)
+    # Filtering from the page itself only needs the new listing.
+    if _is_partial(req):
+        file_list = ''.join(_get_file_list(info))
+        return _partial_reply(req, info, {'file_list': file_list, \
+                                              'page_nav': info['page_nav']})
+    info['user_dir_size'] = aux._bytes_string(catalog._usage(info['uid']))
+    info['quota'] = aux._bytes_string(info['quota'])
+    # Create the sort criteria drops (the secondary one can be blank).
+    for (drop, key, blank) in [('sort_criteria_list', 'sort_criteria', \
+                                    False), \
+                                   ('then_sort_criteria_list', \
+                                        'then_sort_criteria', True)]:
+        info[drop] = '\n'
+        if blank:
+            info[drop] += '<option value="">-</option>\n'
+        for i in info['allowed_sort_criteria']:
+            s = ''
+            if i == prefs['file_manager'][key]:
+                s = 'selected'
+            info[drop] += '<option %s value="%s">%s</option>\n' % \
+                (s, i, i.split('_')[-1].capitalize())
     info.update(prefs['file_manager'])
-    return aux._fill_page(info['file_manager_page_'], info)
+    return aux._send_page(req, info['file_manager_page_'], info, \
+                              'file_list', _get_file_list(info))
+
+
+def _is_partial(req):
+    """Check whether a partial reply was asked for (see
+    '_partial_reply').
+
+       partial = _is_partial(req)
+
+    Returns a boolean.
+    """
+    return 'partial' in req.form
+
+
+def _partial_reply(req, info, reply):
+    """Reply with a small JSON object instead of the whole file manager
+    page.
+
+       return _partial_reply(req, info, reply)
+
+    The file manager page uses these to patch the listing in place (see
+    'file_manager.html'), so the cost of e.g. a deletion does not
+    depend on the number of files. Browsers without JavaScript never
+    ask for them, and get the whole page instead. The token is always
+    included, since it changes with every request if
+    'per_request_token' is True. Returns a string.
+    """
+    import json
+    reply['token'] = info['token']
+    req.content_type = 'application/json'
+    return json.dumps(reply)
+
+
+def _changes(req, info):
+    """Reply with the file tags added, removed and modified since a
+    cursor.
+
+       return _changes(req, info)
+
+    The cursor ('since') is the one returned by the previous call, and
+    holds the catalog versions of the user and of the shared files, as
+    well as the GIDs of the user (joining or leaving a group changes
+    which GID shares are seen). A missing, unknown or too old cursor
+    gets "reset" set, meaning the whole listing has to be fetched again
+    (as does any change the catalog could not log, see 'catalog._bump').
+    The shared files log changes to files of all the users, so these
+    are checked against what the user can see now: those which cannot
+    be seen are only reported as removed if the user's own log has
+    them, or if the client lists them (space separated) in 'known', so
+    that the tags of other users' files are not given away. Tags are
+    reported regardless of the view options (e.g. keyword filters), and
+    after a share change an added tag may already be in the listing (or
+    a modified one not be), so both are best re-fetched. Returns a
+    string (see '_partial_reply').
+    """
+    import catalog
+    gids = '.'.join([str(gid) for gid in sorted(_viewer(info)['gids'])])
+    try:
+        (uid_since, shared_since, gids_since) = \
+            req.form['since'].value.split('-', 2)
+        uid_since = int(uid_since)
+        shared_since = int(shared_since)
+    except:
+        uid_since = shared_since = -1
+        gids_since = None
+    if 'known' in req.form:
+        known = set(req.form['known'].value.split())
+    else:
+        known = set()
+    (uid_version, uid_changes) = catalog._changes(info['uid'], uid_since)
+    (shared_version, shared_changes) = \
+        catalog._changes('shared', shared_since)
+    reply = {'cursor': '%s-%s-%s' % (uid_version, shared_version, gids), \
+                 'added': [], 'removed': [], 'modified': [], \
+                 'reset': False}
+    if uid_changes is None or shared_changes is None or \
+            gids_since != gids:
+        reply['reset'] = True
+        return _partial_reply(req, info, reply)
+    # Every change in the user's own log concerns the user.
+    kinds = {}
+    for (version, file_tag, kind) in uid_changes:
+        kinds.setdefault(file_tag, set()).update([kind, 'own'])
+    for (version, file_tag, kind) in shared_changes:
+        kinds.setdefault(file_tag, set()).add(kind)
+    for file_tag in sorted(kinds):
+        the_file = _file_path(file_tag, info)
+        if the_file and \
+                _can_access(catalog._read_meta(the_file + '-id'), info):
+            if 'added' in kinds[file_tag]:
+                reply['added'].append(file_tag)
+            else:
+                reply['modified'].append(file_tag)
+        elif 'own' in kinds[file_tag] or \
+                ('removed' in kinds[file_tag] and file_tag in known):
+            reply['removed'].append(file_tag)
+    return _partial_reply(req, info, reply)
 
 
 def _check_file_tag(file_tag, login_name):
@@ -155,176 +270,236 @@ def _check_file_tag(file_tag, login_name):
     return
 
 
-def _get_file_list(info):
-    """Get the file listing.
+def _get_entries(info, prefs):
+    """Read the metadata of the files the user can see.
 
-       file_list = _get_file_list(info)
+       entries = _get_entries(info, prefs)
 
-    Returns a string.
+    Applies the access, 'hide_shared' and keyword filters. Returns a
+    list of FileMeta (unsorted).
     """
-    # This function is way too big, it needs to be sensibly split up.
     import logging
     import os
     import fnmatch
-    import time
-    import aux
-    import manage_users
-    import manage_kbasix
+    import catalog
     login_name = info['login_name']
-    logging.debug('Creating a file list (%s)' % login_name)
-    prefs = manage_kbasix._account_info(login_name, 'prefs')
     user_dir = os.path.join(info['users_root_dir_'], str(info['uid']))
-    entries = {}
-    count = {}
-    gids = manage_users._info(login_name)['gids']
-    # Check for local- and GID-shared files.
-    for subdir in ['local'] + [str(i) for i in gids]:
-        subpath = os.path.join(info['shared_dir_'], subdir)
-        if os.path.exists(subpath):
-            # Some house cleaning: delete broken symlinks.
-            for i in os.listdir(subpath):
-                f = os.path.join(subpath, i)
-                # We are lenient with file removals in shared directories
-                # because another user might have beat us to it.
-                if not os.path.exists(f):
-                    try:
-                        os.remove(f)
-                        logging.info('Deleted broken shared symlink "%s" \
-(%s)' % (f, login_name))
-                    except Exception as reason:
-                        logging.warn(reason)
-            for i in fnmatch.filter(os.listdir(subpath), '*-file'):
-                rel_path = os.path.relpath(subpath, user_dir)
-                src = os.path.join(rel_path, i)
-                dst = os.path.join(user_dir, i)
-                # Shared entries which are deleted by the user (the
-                # sharee) are actually hidden from view by adding them
-                # to the 'hidden_gidloc_shared_files' list when the
-                # sharee deletes them.
-                # Once hidden, local/gid-shared files cannot be recovered
-                # unless explicitly re-shared with that user via uid_shares.
-                # Note that if the file exists (important if it's a uid
-                # point share, which takes precedence) we leave it alone.
-                if not os.path.exists(dst) and \
-                        i not in \
-                        prefs['file_manager']['hidden_gidloc_shared_files']:
-                    try:
-                        # The target may not exist, but if the link does,
-                        # delete it.
-                        if os.path.islink(dst + '-id'):
-                            os.remove(dst + '-id')
-                        os.symlink(src + '-id', dst + '-id')
-                    except:
-                        logging.error('Cannot link shared id file "%s" \
-(%s)' % (src + '-id', login_name))
-                    else:
-                        if os.path.islink(dst):
-                            os.remove(dst)
-                        os.symlink(src, dst)
-                        logging.debug('Added shared file "%s" -> "%s" \
-(%s)' % (src, dst, login_name))
-    # Create the listing of the files/symlinks in the user's directory.
-    for i in os.listdir(user_dir):
-        f = os.path.join(user_dir, i)
-        if not os.path.exists(f):
-            try:
-                os.remove(f)
-                logging.info('Deleted broken user symlink "%s" (%s)' % \
-                                 (f, login_name))
-            except Exception as reason:
-                logging.error(reason)
-    for i in fnmatch.filter(os.listdir(user_dir), '*-id'):
-        f = os.path.join(user_dir, i)
-        # This should not normally happen. The magic [:-3] deletes '-id'
-        # and leaves the content file name.
-        if not os.path.exists(f[:-3]):
-            try:
-                os.remove(f)
-                logging.error('Deleted orphan id file "%s" (%s)' % \
-                                  (f, login_name))
-            except Exception as reason:
-                logging.error(reason)
+    shared_rpath = os.path.relpath(info['shared_dir_'], user_dir)
+    hidden = set(prefs['file_manager']['hidden_gidloc_shared_files'])
+    entries = []
+    seen = set()
+    # The user's directory holds the files they own and the one-to-one
+    # shares (symlinks). Local- and GID-shared files are not linked into
+    # every sharee's directory, instead they are read straight from
+    # 'shared_dir_' (minus those the user has deleted, i.e. hidden).
+    # Broken symlinks and orphan id files are skipped.
+    for the_dir in [user_dir] + _shared_dirs(info):
+        if the_dir != user_dir and prefs['file_manager']['hide_shared']:
+            break
+        if not os.path.isdir(the_dir):
             continue
-        details = manage_users._read_file(f, lock=False)
-        # A symlink implies the file is being shared with the user.
-        if os.path.islink(f):
-            details['shared_with_me'] = True
-        else:
-            details['shared_with_me'] = False
-        for j in ['file_title', 'file_description']:
-            if not details[j]: details[j] = info['empty_placeholder_']
-        details['file_date'] = \
-            time.strftime(info['file_manager_time_format_'], \
-                              time.localtime(details['timestamp']))
-        # We need the token for the buttons.
-        details['token'] = info['token']
-        sort_key = details[prefs['file_manager']['sort_criteria']]
-        # We pad with zeros to obtain a natural sorting for entries with
-        # the same non-string keys e.g. size or timestamp. Padding to 50
-        # seems safe, although this is admittedly a magic number
-        # (timestamps have less than 20 digits, and files size are smaller
-        # than that). Worst case scenario is that the sorting on huge
-        # numeric sort keys (larger than 50 digits) will be wrong, but this
-        # is unlikely to happen and has no other consequences.
-        if not isinstance(sort_key, basestring):
-            sort_key = '%r' % sort_key
-            sort_key = sort_key.zfill(50)
-        # We internally distinguish between identical entry values
-        # (say, identical file names), but although lumped together
-        # in their proper place within the overall list they are
-        # not sub-sorted in any deliberate way.
-        if sort_key not in entries:
-            count[sort_key] = 1
-            entries[sort_key] = details
-        else:
-            count[sort_key] += 1
-            entries[sort_key + ' (%s)' % count[sort_key]] = details
-    if prefs['file_manager']['condensed_view']:
-        info['template'] = 'condensed_entry_template_'
-    else:
-        info['template'] = 'entry_template_'
-    file_list = ''
-    for key in sorted(entries, \
-                          reverse=bool(prefs['file_manager']['reverse'])):
-        entries[key]['shared_status'] = ''
-        entries[key]['file_colour'] = info['my_file_colour_']
-        if entries[key]['shared_with_me']:
-            # World shares are not symlinked with the individual accounts,
-            # and entries which cannot be read any longer are deleted.
-            if not entries[key]['local_share'] and \
-                    not info['uid'] in entries[key]['uid_shares'] and not \
-                    set(gids).intersection(set(entries[key]['gid_shares'])):
-                shared_file = \
-                    os.path.join(user_dir, entries[key]['file_tag'])
-                try:
-                    os.remove(shared_file)
-                    os.remove(shared_file + '-id')
-                except Exception as reason:
-                    logging.error(reason)
+        for i in fnmatch.filter(os.listdir(the_dir), '*-id'):
+            # The magic [:-3] deletes '-id' and leaves the content file
+            # name.
+            file_tag = i[:-3]
+            if file_tag in seen:
                 continue
-            # Don't show the shares made by no-longer-exsting users if
-            # 'exusers_cannot_share' is True.
-            elif not manage_users._info(entries[key]['owner_uid']) and \
-                    info['exusers_cannot_share']:
+            f = os.path.join(the_dir, i)
+            if the_dir == user_dir:
+                # Links into 'shared_dir_' are left over from earlier
+                # versions (see 'manage_kbasix._unlink_gidloc_shares'),
+                # the file is listed from there.
+                if os.path.islink(f) and \
+                        os.readlink(f).startswith(shared_rpath):
+                    continue
+            elif file_tag in hidden:
                 continue
-            else:
-                entries[key]['shared_status'] = """
+            if not os.path.exists(f) or not os.path.exists(f[:-3]):
+                logging.debug('Skipping unavailable file "%s" (%s)' % \
+                                  (f, login_name))
+                continue
+            details = catalog._read_meta(f)
+            # A symlink implies the file is being shared with the user
+            # (the user's own files show up in the shared directories
+            # too, but they have been seen by then).
+            details['shared_with_me'] = os.path.islink(f)
+            if details['shared_with_me']:
+                if prefs['file_manager']['hide_shared']:
+                    continue
+                # World shares are not listed, and neither are entries
+                # which cannot be read any longer (their one-to-one
+                # links are removed when the shares change).
+                if not _can_access(details, info):
+                    continue
+            seen.add(file_tag)
+            for j in ['file_title', 'file_description']:
+                if not details[j]: details[j] = info['empty_placeholder_']
+            if prefs['file_manager']['keywords'] and \
+                    not _keyword_match(prefs['file_manager']['keywords'], \
+                                           details):
+                continue
+            entries.append(details)
+    return entries
+
+
+def _shared_dirs(info):
+    """List the shared directories the user's GID and local shares are
+    found in.
+
+       dirs = _shared_dirs(info)
+
+    Returns a list of paths (which may not exist).
+    """
+    import os
+    gids = sorted(_viewer(info)['gids'])
+    return [os.path.join(info['shared_dir_'], str(i)) for i in \
+                ['local'] + gids]
+
+
+def _file_path(file_tag, info):
+    """Find the content file a file tag refers to.
+
+       the_file = _file_path(file_tag, info)
+
+    Files owned by the user, and one-to-one shares, are in the user's
+    directory, whereas GID and local shares are looked up in the shared
+    directories (see '_shared_dirs'), unless hidden by the user.
+    Returns a string with the path (an empty one if either the metadata
+    or content file isn't there).
+    """
+    import os
+    import manage_kbasix
+    user_dir = os.path.join(info['users_root_dir_'], str(info['uid']))
+    for the_dir in [user_dir] + _shared_dirs(info):
+        the_file = os.path.join(the_dir, file_tag)
+        if not os.path.exists(the_file) or \
+                not os.path.exists(the_file + '-id'):
+            continue
+        if the_dir != user_dir:
+            prefs = manage_kbasix._account_info(info['login_name'], 'prefs')
+            if 'file_manager' in prefs and file_tag in \
+                    prefs['file_manager']['hidden_gidloc_shared_files']:
+                return ''
+        return the_file
+    return ''
+
+
+def _keyword_match(keywords, details):
+    """Check whether all the keywords appear in a file's title or
+    description.
+
+       match = _keyword_match(keywords, details)
+
+    Returns a boolean.
+    """
+    # The keyword filter. This is actually a very important
+    # functionality. It is currently very weak, and should be drastically
+    # improved. Right now is just filters on words in the file title
+    # and description, ignoring punctuation. It is also
+    # case-insensitive.
+    import re
+    # Use '[\W_]+' to eliminate underscores. See also:
+    #
+    # http://stackoverflow.com/questions/6631870/strip-non-alpha-numeric-characters-from-string-in-python-but-keeping-special-cha
+    #
+    # The 're.U' works on unicode strings.
+    nonalnum = re.compile('[\W]+', re.U)
+    keywords = set([i.lower() for i in keywords.split()])
+    words = [nonalnum.sub('', i.lower()) for i in \
+                 details['file_title'].split()]
+    words += [nonalnum.sub('', i.lower()) for i in \
+                  details['file_description'].split()]
+    return keywords <= set(words)
+
+
+def _sort_key(criteria):
+    """Make the sort key function for a list of sort criteria.
+
+       key = _sort_key(criteria)
+
+    The keys are tuples of native values (strings are compared
+    case-insensitively, and 'file_date' sorts by timestamp), followed by
+    the timestamp and file tag so that ties are always broken the same
+    way. Returns a function.
+    """
+    fields = []
+    for i in criteria:
+        if i == 'file_date':
+            i = 'timestamp'
+        fields.append(i)
+    fields += ['timestamp', 'file_tag']
+    def key(details):
+        values = []
+        for i in fields:
+            value = details[i]
+            if isinstance(value, basestring):
+                value = value.lower()
+            values.append(value)
+        return tuple(values)
+    return key
+
+
+def _select_entries(entries, criteria, reverse, page, per_page):
+    """Sort the entries and pick out a page of them.
+
+       selected = _select_entries(entries, criteria, reverse, page,
+                                  per_page)
+
+    If 'per_page' is 0 all the entries are sorted and returned. Otherwise
+    only the entries up to the end of the requested page (counting from
+    0) are selected, via a heap, which is cheaper than sorting the whole
+    list when there are many more entries than shown. Returns a list.
+    """
+    import heapq
+    key = _sort_key(criteria)
+    if not per_page:
+        return sorted(entries, key=key, reverse=reverse)
+    n = (page + 1) * per_page
+    if reverse:
+        selected = heapq.nlargest(n, entries, key=key)
+    else:
+        selected = heapq.nsmallest(n, entries, key=key)
+    return selected[page * per_page:]
+
+
+def _render_entry(details, info):
+    """Render a file manager entry.
+
+       entry = _render_entry(details, info)
+
+    Returns a string.
+    """
+    import time
+    import aux
+    # The rendered values go in a throw-away dictionary, so that only
+    # one of these is around at any time.
+    details = dict(details.items())
+    details['file_date'] = \
+        time.strftime(info['file_manager_time_format_'], \
+                          time.localtime(details['timestamp']))
+    # We need the token for the buttons.
+    details['token'] = info['token']
+    details['shared_status'] = ''
+    details['file_colour'] = info['my_file_colour_']
+    # Shared files can be copied internally (it's more efficient than
+    # downloading and uploading again).
+    details['copy_file'] = ''
+    if details['shared_with_me']:
+        details['shared_status'] = """
                  <img src="%s" title="File shared with me by: %s"
                    alt="[File shared with me by: %s]" />
-""" % (info['shared_icon_with_me_'], entries[key]['owner'], \
-           entries[key]['owner'])
-                entries[key]['file_colour'] = info['other_file_colour_']
-        if prefs['file_manager']['hide_shared'] and \
-                entries[key]['shared_with_me']:
-            continue
-        # Shared files can be copied internally (it's more efficient than
-        # downloading and uploading again).
-        entries[key]['copy_file'] = ''
-        if entries[key]['shared_with_me']:
-            entries[key]['copy_file_icon_'] = info['copy_file_icon_']
-            entries[key]['copy_file_form_style_'] = \
-                info['copy_file_form_style_'] 
-            entries[key]['copy_file'] = """
+""" % (info['shared_icon_with_me_'], details['owner'], details['owner'])
+        details['file_colour'] = info['other_file_colour_']
+        details['copy_file_icon_'] = info['copy_file_icon_']
+        details['copy_file_form_style_'] = info['copy_file_form_style_']
+        if info['compact_listing']:
+            details['copy_file'] = """
+             <button form="files" formaction="process?action=copy_file"
+              name="file_tag" value="%(file_tag)s" title="Make a local copy">
+              <img src="%(copy_file_icon_)s" alt="Make a local copy"></button>
+""" % details
+        else:
+            details['copy_file'] = """
              <form %(copy_file_form_style_)s
               action="../file_manager.py/process?action=copy_file"
               method="post">
@@ -333,75 +508,226 @@ def _get_file_list(info):
               <input title="Make a local copy" type="image"
               alt="Make a local copy" src="%(copy_file_icon_)s" />
              </form>
-""" % entries[key]
-        # Files that are shared (the user being the sharer) are tagged
-        # in various ways to indicate this.
-        else:
-            if entries[key]['world_share']:
-                entries[key]['shared_status'] += """
+""" % details
+    # Files that are shared (the user being the sharer) are tagged
+    # in various ways to indicate this.
+    else:
+        if details['world_share']:
+            details['shared_status'] += """
                  <img src="%s" title="File is shared with the world"
                   alt="[File is shared with the world]" />
 """ % info['shared_icon_by_me_to_world_']
-            if entries[key]['local_share']:
-                entries[key]['shared_status'] += """
+        if details['local_share']:
+            details['shared_status'] += """
                  <img src="%s" title="File is shared with registered users"
                   alt="[File is shared with registered users]" />
 """ % info['shared_icon_by_me_locally_']
-            if entries[key]['gid_shares']:
-                entries[key]['shared_status'] += """
+        if details['gid_shares']:
+            details['shared_status'] += """
                  <img src="%s" title="File is shared with selected groups"
                   alt="[File is shared with selected groups]" />
 """ % info['shared_icon_by_me_to_groups_']
-            if entries[key]['uid_shares']:
-                entries[key]['shared_status'] += """
+        if details['uid_shares']:
+            details['shared_status'] += """
                  <img src="%s" title="File is shared with selected users"
                   alt="[File is shared with selected users]" />
 """ % info['shared_icon_by_me_selectively_']
-        # Convert the size to a string with the appropriate unit suffix e.g.
-        # 'MB'.
-        entries[key]['file_size_str'] = \
-            aux._bytes_string(entries[key]['file_size'])
-        entries[key]['toggle_select'] = info['toggle_select']
-        # Limit the length of titles and descriptions.
-        for i in ['description', 'title']:
-            if info['max_chars_in_' + i]:
-                max_char = len(entries[key]['file_' + i])
-                char_num = min(max_char, info['max_chars_in_' + i])
-                entries[key][i + '_blurb'] = \
-                    entries[key]['file_' + i][:char_num]
-                if max_char > char_num:
-                    entries[key][i + '_blurb'] += '...'
-            else:
-                entries[key][i + '_blurb'] = entries[key]['file_' + i]
-        # The keyword filter. This is actually a very important
-        # functionality, and should be split into its own function.
-        # Furthermore, it is currently very weak, and should be drastically
-        # improved. Right now is just filters on words in the file title
-        # and description, ignoring punctuation. It is also
-        # case-insensitive.
-        if prefs['file_manager']['keywords']:
-            import re
-            # Use '[\W_]+' to eliminate underscores. See also:
-            #
-            # http://stackoverflow.com/questions/6631870/strip-non-alpha-numeric-characters-from-string-in-python-but-keeping-special-cha
-            #
-            # The 're.U' works on unicode strings.
-            nonalnum = re.compile('[\W]+', re.U)
-            keywords = set([i.lower() for i in \
-                                prefs['file_manager']['keywords'].split()])
-            words = [nonalnum.sub('', i.lower()) for i in \
-                         entries[key]['file_title'].split()]
-            words += [nonalnum.sub('', i.lower()) for i in \
-                          entries[key]['file_description'].split()]
-            if keywords <= set(words):
-                file_list += aux._fill_str(info[info['template']], \
-                                               entries[key])
-            continue
-        file_list += aux._fill_str(info[info['template']], entries[key])
-    if not file_list:
-        return info['no_files_found_']
+    # Convert the size to a string with the appropriate unit suffix e.g.
+    # 'MB'.
+    details['file_size_str'] = aux._bytes_string(details['file_size'])
+    details['toggle_select'] = info['toggle_select']
+    # Limit the length of titles and descriptions.
+    for i in ['description', 'title']:
+        if info['max_chars_in_' + i]:
+            max_char = len(details['file_' + i])
+            char_num = min(max_char, info['max_chars_in_' + i])
+            details[i + '_blurb'] = details['file_' + i][:char_num]
+            if max_char > char_num:
+                details[i + '_blurb'] += '...'
+        else:
+            details[i + '_blurb'] = details['file_' + i]
+    return aux._fill_str(info[info['template']], details)
+
+
+def _entry_template(info, prefs):
+    """Pick the template the file manager entries are rendered with.
+
+       _entry_template(info, prefs)
+
+    Sets info['template'] (see '_render_entry'). Returns nothing.
+    """
+    if prefs['file_manager']['condensed_view']:
+        info['template'] = 'condensed_entry_template_'
     else:
-        return file_list
+        info['template'] = 'entry_template_'
+    if info['compact_listing']:
+        info['template'] = 'compact_' + info['template']
+    return
+
+
+def _page_nav(info, page, per_page, total):
+    """Make the page navigation buttons of the file manager.
+
+       nav = _page_nav(info, page, per_page, total)
+
+    Returns a string (empty if everything fits in one page).
+    """
+    if not per_page or total <= per_page:
+        return ''
+    last = (total - 1) // per_page
+    button = """
+      <form class="page_nav" action="process?start" method="post">
+        <input type="hidden" name="token" value="%s" />
+        <input type="hidden" name="page" value="%s" />
+        <input type="submit" value="%s" />
+      </form>"""
+    nav = ''
+    if page > 0:
+        nav += button % (info['token'], page - 1, 'Previous')
+    nav += '\n      <p class="page_nav">Showing %s-%s of %s</p>' % \
+        (page * per_page + 1, min((page + 1) * per_page, total), total)
+    if page < last:
+        nav += button % (info['token'], page + 1, 'Next')
+    return nav
+
+
+def _iter_file_list(info, prefs):
+    """Render the file listing one entry at a time.
+
+       for entry in _iter_file_list(info, prefs): ...
+
+    All the entries are gathered and sorted before the first one is
+    rendered, at which point the page navigation is set in
+    info['page_nav']. Returns a generator (of strings).
+    """
+    entries = _get_entries(info, prefs)
+    total = len(entries)
+    per_page = info['entries_per_page']
+    page = info['page']
+    if per_page and page * per_page >= total:
+        page = max(0, (total - 1) // per_page)
+    criteria = [prefs['file_manager']['sort_criteria']]
+    if prefs['file_manager']['then_sort_criteria']:
+        criteria.append(prefs['file_manager']['then_sort_criteria'])
+    entries = _select_entries(entries, criteria, \
+                                  bool(prefs['file_manager']['reverse']), \
+                                  page, per_page)
+    info['page_nav'] = _page_nav(info, page, per_page, total)
+    _entry_template(info, prefs)
+    if not entries:
+        yield info['no_files_found_']
+    for details in entries:
+        yield _render_entry(details, info)
+
+
+# Rendered file listings, kept for as long as the Apache child lives
+# (see '_get_file_list'). The cache is a dictionary of
+# key: [last_used, file_list, page_nav] lists.
+_list_cache = {}
+_list_cache_state = {'tick': 0, 'bytes': 0}
+# The token is only known at serve time, so cached listings are rendered
+# with this stand-in. User-provided metadata is HTML-escaped, so it can
+# never contain it.
+_token_placeholder = '<%token%>'
+
+
+def _list_cache_key(info, prefs):
+    """Make the key under which a rendered file listing is cached.
+
+       key = _list_cache_key(info, prefs)
+
+    The listing depends on the user, on the catalog versions of the user
+    and of the shared files, on the groups the user belongs to (which
+    decide the GID shares seen), and on the view options. Returns a
+    tuple.
+    """
+    import catalog
+    options = [(key, value) for (key, value) in \
+                   prefs['file_manager'].items() if \
+                   key != 'hidden_gidloc_shared_files']
+    return (info['uid'], catalog._version(info['uid']), \
+                catalog._version('shared'), \
+                tuple(sorted(_viewer(info)['gids'])), info['page'], \
+                info['entries_per_page'], info['toggle_select'], \
+                tuple(sorted(options)))
+
+
+def _list_cache_store(key, file_list, page_nav, info):
+    """Store a rendered file listing, evicting the least recently used
+    ones to keep within 'list_cache_entries' and 'list_cache_bytes'.
+
+       _list_cache_store(key, file_list, page_nav, info)
+
+    Returns nothing.
+    """
+    size = len(file_list) + len(page_nav)
+    if size > info['list_cache_bytes']:
+        return
+    _list_cache_state['tick'] += 1
+    if key in _list_cache:
+        _list_cache_state['bytes'] -= \
+            len(_list_cache[key][1]) + len(_list_cache[key][2])
+    _list_cache[key] = [_list_cache_state['tick'], file_list, page_nav]
+    _list_cache_state['bytes'] += size
+    while len(_list_cache) > info['list_cache_entries'] or \
+            _list_cache_state['bytes'] > info['list_cache_bytes']:
+        oldest = min(_list_cache, key=lambda i: _list_cache[i][0])
+        _list_cache_state['bytes'] -= \
+            len(_list_cache[oldest][1]) + len(_list_cache[oldest][2])
+        del _list_cache[oldest]
+    return
+
+
+def _get_file_list(info):
+    """Get the file listing.
+
+       chunks = _get_file_list(info)
+
+    Rendered listings are cached (see 'list_cache_entries' in defs.py).
+    Returns a generator (of strings), see '_iter_file_list'. The page
+    navigation is set in info['page_nav'] before the first string is
+    produced.
+    """
+    import logging
+    import manage_kbasix
+    login_name = info['login_name']
+    prefs = manage_kbasix._account_info(login_name, 'prefs')
+    if not info['list_cache_entries']:
+        logging.debug('Creating a file list (%s)' % login_name)
+        for chunk in _iter_file_list(info, prefs):
+            yield chunk
+        return
+    key = _list_cache_key(info, prefs)
+    if key in _list_cache:
+        logging.debug('Using a cached file list (%s)' % login_name)
+        _list_cache_state['tick'] += 1
+        _list_cache[key][0] = _list_cache_state['tick']
+        (file_list, page_nav) = _list_cache[key][1:]
+        info['page_nav'] = page_nav.replace(_token_placeholder, \
+                                                info['token'])
+        yield file_list.replace(_token_placeholder, info['token'])
+        return
+    logging.debug('Creating a file list (%s)' % login_name)
+    view = info.copy()
+    view['token'] = _token_placeholder
+    # The rendered entries are kept for the cache only for as long as
+    # they fit in it, so that streaming a huge listing does not end up
+    # holding all of it in memory anyway.
+    kept = []
+    size = 0
+    for (n, chunk) in enumerate(_iter_file_list(view, prefs)):
+        if n == 0:
+            info['page_nav'] = view['page_nav'].replace(_token_placeholder, \
+                                                            info['token'])
+        if kept is not None:
+            size += len(chunk)
+            if size > info['list_cache_bytes']:
+                kept = None
+            else:
+                kept.append(chunk)
+        yield chunk.replace(_token_placeholder, info['token'])
+    if kept is not None:
+        _list_cache_store(key, ''.join(kept), view['page_nav'], info)
 
 
 def _get_file_info(file_tag, info):
@@ -418,14 +744,32 @@ def _get_file_info(file_tag, info):
     logging.debug('Getting file metadata for "%s" (%s)' % \
                       (file_tag, info['login_name']))
     _check_file_tag(file_tag, info['login_name'])
-    the_file = os.path.join(info['users_root_dir_'], str(info['uid']), \
-                                file_tag)
-    the_id_file = the_file + '-id'
-    if not os.path.exists(the_id_file) or not os.path.exists(the_file):
+    the_file = _file_path(file_tag, info)
+    if not the_file:
         logging.warn('Unable to retrieve file metadata and/or content \
-for "%s" (%s)' % (the_id_file, info['login_name']))
+for "%s" (%s)' % (file_tag, info['login_name']))
         return {}
-    return manage_users._read_file(the_id_file, lock=False)
+    return manage_users._read_file(the_file + '-id', lock=False)
+
+
+def _get_file_meta(file_tag, info):
+    """Read the fixed file metadata (see 'catalog.FileMeta').
+
+       file_meta = _get_file_meta(file_tag, info)
+
+    This is what the permission checks, downloads and deletions need.
+    Returns a FileMeta (None if either the metadata or content file
+    isn't there).
+    """
+    import logging
+    import catalog
+    _check_file_tag(file_tag, info['login_name'])
+    the_file = _file_path(file_tag, info)
+    if not the_file:
+        logging.warn('Unable to retrieve file metadata and/or content \
+for "%s" (%s)' % (file_tag, info['login_name']))
+        return None
+    return catalog._read_meta(the_file + '-id')
 
 
 def _confirm_delete(req, info):
@@ -440,7 +784,7 @@ def _confirm_delete(req, info):
     logging.debug('File deletion requested (%s)' % info['login_name'])
     info['file_tag'] = req.form['file_tag'].value
     _check_file_tag(info['file_tag'], info['login_name'])
-    file_info = _get_file_info(info['file_tag'], info)
+    file_info = _get_file_meta(info['file_tag'], info)
     # There is a check to see whether the file has the
     # appropriate access permissions, but it seems redundant
     # (the file is either deleted now or when the user refreshes
@@ -480,11 +824,13 @@ def _confirm_bulk_delete(req, info):
 
     Returns a status page.
     """
+    import itertools
     import logging
     import aux
     logging.debug('Bulk file deletion requested (%s)' % info['login_name'])
     info['title'] = 'Confirm the deletion of selected files'
-    files = info['file_tags'] = ''
+    info['file_tags'] = ''
+    files = []
     n = 0
     if 'bulk' not in req.form or not req.form['bulk']:
         info['details'] = 'No files selected'
@@ -497,7 +843,7 @@ def _confirm_bulk_delete(req, info):
         if not isinstance(req.form['bulk'], list):
             file_tag = req.form['bulk'].value
         _check_file_tag(file_tag, info['login_name'])
-        file_info = _get_file_info(file_tag, info)
+        file_info = _get_file_meta(file_tag, info)
         # We're not checking permissions on each file (see the
         # comment in '_confirm_delete'). It'd be a hassle to
         # mess up a carefully selected list of files to announce
@@ -507,7 +853,7 @@ def _confirm_bulk_delete(req, info):
         # because they have been deleted or access to them denied.
         if file_info:
             info['file_tags'] += ' ' + file_tag
-            files += file_info['file_name'] + '<br>'
+            files.append(file_info['file_name'])
             n += 1
         if not isinstance(req.form['bulk'], list): break
     if n == 0:
@@ -528,7 +874,6 @@ def _confirm_bulk_delete(req, info):
         q = 'file'
     else:
         q = '%s files' % n
-    info['details'] = 'Really delete the following %s?<br>%s' % (q, files)
     info['status_button_1'] = """
           <form action="../file_manager.py/process?action=delete"
             method="post">
@@ -544,7 +889,11 @@ def _confirm_bulk_delete(req, info):
           </form>
 """ % info
     info['class'] = 'information'
-    return aux._fill_page(info['status_page_'], info)
+    # The list of files can be long, so it is streamed.
+    details = itertools.chain(['Really delete the following %s?<br>' % q], \
+                                  (i + '<br>' for i in files))
+    return aux._send_page(req, info['status_page_'], info, 'details', \
+                              details)
 
 
 def _delete_file(req, info):
@@ -556,58 +905,91 @@ def _delete_file(req, info):
     """
     import logging
     import os
+    import blobs
+    import catalog
     import manage_kbasix
+    import manage_users
+    import metaeditor
     if 'file_tag' in req.form:
         file_tags = [req.form['file_tag'].value]
     elif 'file_tags' in req.form:
         file_tags_str = req.form['file_tags'].value
         file_tags = file_tags_str.split()
+    the_dir = os.path.join(info['users_root_dir_'], str(info['uid']))
+    shared_rpath = os.path.relpath(info['shared_dir_'], the_dir)
+    prefs = manage_kbasix._account_info(info['login_name'], 'prefs')
+    # The file manager preferences are set the first time it is used.
+    if 'file_manager' in prefs:
+        hidden = prefs['file_manager']['hidden_gidloc_shared_files']
+    else:
+        hidden = []
+    hid = False
+    removed = []
+    # The space freed up by deleting files the user owns.
+    freed = 0
     for file_tag in file_tags:
         _check_file_tag(file_tag, info['login_name'])
-        the_dir = os.path.join(info['users_root_dir_'], str(info['uid']))
-        the_file = os.path.join(the_dir, file_tag)
+        the_file = _file_path(file_tag, info)
         the_id_file = the_file + '-id'
-        # This shouldn't really happen as a file which is no-longer shared
-        # doesn't have its symlink removed until the file manager is
-        # refreshed.
-        if not os.path.exists(the_file):
+        # This can happen if the file was unshared from underneath the
+        # user.
+        if not the_file:
             logging.warn('File "%s" has vanished (%s)' % \
-                             (the_file, info['login_name']))
-            continue
-        if not os.path.exists(the_id_file):
-            logging.warn('The id file "%s" has vanished (%s)' % \
-                             (the_id_file, info['login_name']))
+                             (file_tag, info['login_name']))
             continue
         verb = 'Deleted'
         try:
+            # GID/local shares are read from the shared directories, so
+            # when deleted they are hidden "never to be seen again".
+            # This includes the symlinks left over from earlier versions,
+            # which we can tell by inspecting the symlink prefix.
+            if os.path.dirname(the_file) != the_dir or \
+                    (os.path.islink(the_file) and \
+                         os.readlink(the_file).startswith(shared_rpath)):
+                verb = 'Hid'
+                if file_tag not in hidden:
+                    hidden.append(file_tag)
+                    hid = True
+                if os.path.dirname(the_file) == the_dir:
+                    os.remove(the_id_file)
+                    os.remove(the_file)
             # Metadata files are renamed: they are small and keep
             # a history of what was there. This is only done for
             # files the user actually owns.
-            if not os.path.islink(the_file):
+            elif not os.path.islink(the_file):
+                # The sharees' links are removed along with the shares.
+                file_info = manage_users._read_file(the_id_file, \
+                                                        lock=False)
+                metaeditor._unshare(file_info, info)
                 os.rename(the_id_file, the_id_file + '-removed')
+                custom_file = catalog._custom_file(the_id_file)
+                if os.path.isfile(custom_file):
+                    os.rename(custom_file, custom_file + '-removed')
+                freed += os.path.getsize(the_file)
+                os.remove(the_file)
+                # The content goes once no other file has it.
+                if info['blob_store'] and 'file_sha256sum' in file_info:
+                    try:
+                        blobs._unref(file_info['file_sha256sum'])
+                    except Exception as reason:
+                        logging.warn(reason)
+            # One-to-one shares are also symlinks, but when deleted
+            # those are not hidden (i.e. they can be re-shared), but
+            # instead just deleted.
             else:
-                prefs = manage_kbasix._account_info(info['login_name'], \
-                                                        'prefs')
-                # One-to-one shares are also symlinks, but when deleted
-                # those are not hidden "never to be seen again" (i.e. they
-                # can be re-shared), but instead just deleted.
-                # We can tell if the share is of type GID/local by
-                # inspecting the symlink prefix:
-                shared_rpath = os.path.relpath(info['shared_dir_'], the_dir)
-                if os.readlink(the_file).startswith(shared_rpath) and \
-                        file_tag not in \
-                        prefs['file_manager']['hidden_gidloc_shared_files']:
-                    verb = 'Hid'
-                    prefs['file_manager']['hidden_gidloc_shared_files'].append(file_tag)
                 os.remove(the_id_file)
-                manage_kbasix._account_mod(info['login_name'], 'prefs', \
-                                               prefs)
-            os.remove(the_file)
+                os.remove(the_file)
         except Exception as reason:
             raise DeleteFileError('Unable to delete file "%s" because \
 "%s" (%s)' % (the_file, reason, info['login_name']))
+        removed.append(file_tag)
         logging.debug('%s file "%s" (%s)' % \
                           (verb, the_file, info['login_name']))
+    if hid and 'file_manager' in prefs:
+        manage_kbasix._account_mod(info['login_name'], 'prefs', prefs)
+    catalog._bump(info['uid'], removed, 'removed', -freed)
+    if _is_partial(req):
+        return _partial_reply(req, info, {'removed': removed})
     return _initialize(req, info)
 
 
@@ -620,8 +1002,6 @@ def _check_permissions(file_info, info):
     otherwise.
     """
     import aux
-    import manage_users
-    gids = manage_users._info(info['login_name'])['gids']
     denied_page = ''
     info['title'] = 'File unavailable'
     info['details'] = 'You no longer have access to this file.'
@@ -633,16 +1013,50 @@ def _check_permissions(file_info, info):
 """ % info['token']
     info['status_button_2'] = ''
     info['class'] = 'warning'
-    if not file_info:
-        denied_page = aux._fill_page(info['status_page_'], info)
-    elif not info['uid'] == file_info['owner_uid'] and \
-            not file_info['local_share'] and \
-            not info['uid'] in file_info['uid_shares'] and \
-            not set(gids).intersection(set(file_info['gid_shares'])):
+    if not file_info or not _can_access(file_info, info):
         denied_page = aux._fill_page(info['status_page_'], info)
     return denied_page
 
 
+def _viewer(info):
+    """Gather what the permission checks need to know about the user,
+    once per request.
+
+       viewer = _viewer(info)
+
+    The result is kept in info['viewer'], so the account and group
+    files are read at most once however many files are checked.
+    Returns a dictionary with the GIDs of the user ('gids') and the
+    UIDs of all existing users ('uids'), both as sets.
+    """
+    import manage_users
+    if 'viewer' not in info:
+        info['viewer'] = {}
+        info['viewer']['gids'] = \
+            set(manage_users._info(info['login_name'])['gids'])
+        info['viewer']['uids'] = manage_users._ids()
+    return info['viewer']
+
+
+def _can_access(file_info, info):
+    """Check whether the user can access a file.
+
+       allowed = _can_access(file_info, info)
+
+    Shares made by no-longer-existing users are not honoured if
+    'exusers_cannot_share' is True. Returns a boolean.
+    """
+    viewer = _viewer(info)
+    if info['uid'] == file_info['owner_uid']:
+        return True
+    if info['exusers_cannot_share'] and \
+            file_info['owner_uid'] not in viewer['uids']:
+        return False
+    return bool(file_info['local_share']) or \
+        info['uid'] in file_info['uid_shares'] or \
+        not viewer['gids'].isdisjoint(file_info['gid_shares'])
+
+
 def _copy_file(req, info):
     """Copy a file internally (within KBasix).
 
@@ -655,25 +1069,42 @@ def _copy_file(req, info):
     import os
     import hashlib
     import time
-    import shutil
     import json
+    import blobs
+    import catalog
+    import defs
     import manage_users
     import upload
     (info['user_dir_size'], over_page) = upload._check_quota(req, 'copy', \
                                                                  info)
     if info['user_dir_size'] < 0:
+        if _is_partial(req):
+            return _partial_reply(req, info, {'error': info['details']})
         return over_page
     user_dir = os.path.join(info['users_root_dir_'], str(info['uid']))
     hash_val = hashlib.sha256(os.urandom(info['random_length'])).hexdigest()
     dst_file_tag = '%r-%s-file' % (time.time(), hash_val)
     src_file_tag = req.form['file_tag'].value
     _check_file_tag(src_file_tag, info['login_name'])
-    file_info = _get_file_info(src_file_tag, info)
+    file_info = _get_file_meta(src_file_tag, info)
     denied_page = _check_permissions(file_info, info)
     if denied_page:
+        if _is_partial(req):
+            return _partial_reply(req, info, {'error': info['details']})
         return denied_page
-    src_file = os.path.join(user_dir, src_file_tag)
+    # The source may be a GID or local share (see '_file_path').
+    src_file = _file_path(src_file_tag, info)
     src_id_file = src_file + '-id'
+    # The copy must fit in the space left (see 'catalog._reserve').
+    (reservation, size) = catalog._reserve(info['uid'], \
+                                               os.path.getsize(src_file), \
+                                               info['quota'])
+    if not reservation:
+        over_page = upload._over_quota_page(req, 'copy', info, \
+                                                info['quota_fit_blurb'])
+        if _is_partial(req):
+            return _partial_reply(req, info, {'error': info['details']})
+        return over_page
     dst_file = os.path.join(user_dir, dst_file_tag)
     dst_id_file = dst_file + '-id'
     id_info = manage_users._read_file(src_id_file, lock=False)
@@ -687,25 +1118,138 @@ def _copy_file(req, info):
     id_info['world_share'] = False
     id_info['timestamp'] = time.time()
     id_info['file_tag'] = dst_file_tag
-    id_info['custom'] = {}
+    # Custom metadata is kept apart (see 'catalog._read_custom') and is
+    # not copied, but earlier versions kept it within the metadata.
+    if 'custom' in id_info:
+        del id_info['custom']
+    # The digests of the source, if it has them all (older files may
+    # not).
+    digests = {}
+    for name in upload._digest_names(defs.upload):
+        if 'file_%ssum' % name in id_info:
+            digests[name] = id_info['file_%ssum' % name]
+    if len(digests) < len(upload._digest_names(defs.upload)):
+        digests = {}
+    # With the blob store the copy is just a link to the same content
+    # (see 'blobs._link'). Failing that, on filesystems which support it
+    # the copy shares the data blocks of the source until either is
+    # changed (see 'upload._reflink'). Only otherwise is the data
+    # actually copied, and then the digests are taken afresh on the way
+    # rather than trusting (or lacking) those of the source.
+    how = ''
+    if info['blob_store'] and 'sha256' in digests:
+        try:
+            blobs._link(src_file, digests['sha256'], dst_file)
+            how = 'linked'
+        except Exception as reason:
+            logging.warn(reason)
+    try:
+        if not how and info['reflink_copies'] and \
+                upload._reflink(src_file, dst_file):
+            how = 'cloned'
+            if not digests:
+                digests = upload._hash_file(dst_file, defs.upload)
+        if not how:
+            digests = upload._copy_hashed(src_file, dst_file, defs.upload)
+            how = 'copied'
+        if how != 'linked' and info['blob_store'] and 'sha256' in digests:
+            blobs._store(dst_file, digests['sha256'])
+    except Exception as reason:
+        catalog._release(info['uid'], reservation)
+        if os.path.isfile(dst_file):
+            os.remove(dst_file)
+            _unref_copy(digests, info)
+        logging.critical('Unable to copy file "%s" because "%s" (%s)' % \
+                             (src_file, reason, info['login_name']))
+        raise CopyFileError('Unable to copy file')
+    for name in digests:
+        id_info['file_%ssum' % name] = digests[name]
     try:
         f = open(dst_id_file, 'wb')
         json.dump(id_info, f)
         f.close()
         os.chmod(dst_id_file, 0600)
     except Exception as reason:
+        catalog._release(info['uid'], reservation)
+        os.remove(dst_file)
+        _unref_copy(digests, info)
         logging.critical('Unable to create id file "%s" because "%s" \
 (%s)' % (dst_id_file, reason, info['login_name']))
         raise CopyFileError('Unable to create id file')
+    catalog._bump(info['uid'], [dst_file_tag], 'added', \
+                      os.path.getsize(dst_file), reservation)
+    _count_copy(how, info)
+    logging.debug('Copied (%s) file "%s" -> "%s" (%s)' % \
+                      (how, src_file, dst_file, info['login_name']))
+    if _is_partial(req):
+        return _partial_reply(req, info, \
+                                  {'added': [_render_new_entry(dst_id_file, \
+                                                                   info)]})
+    return _initialize(req, info)
+
+
+def _unref_copy(digests, info):
+    """Drop the content of a copy which failed from the blob store,
+    unless other files have it (see '_copy_file').
+
+       _unref_copy(digests, info)
+
+    Failing to do so is not an error. Returns nothing.
+    """
+    import logging
+    import blobs
+    if info['blob_store'] and 'sha256' in digests:
+        try:
+            blobs._unref(digests['sha256'])
+        except Exception as reason:
+            logging.warn(reason)
+    return
+
+
+def _count_copy(how, info):
+    """Count how internal copies are made (see '_copy_file').
+
+       _count_copy(how, info)
+
+    The 'how' is one of 'linked', 'cloned' or 'copied', and the counts
+    are kept in 'copy_stats_file_'. Failing to count is not an error.
+    Returns nothing.
+    """
+    import os
+    import logging
+    import manage_users
+    stats_file = info['copy_stats_file_']
     try:
-        shutil.copy2(src_file, dst_file)
+        manage_users._padlock(stats_file, 'lock')
+        if os.path.isfile(stats_file):
+            stats = manage_users._read_file(stats_file, lock=False)
+        else:
+            stats = {}
+        stats[how] = stats.get(how, 0) + 1
+        manage_users._save_file(stats, stats_file, backup=False)
     except Exception as reason:
-        logging.critical('Unable to copy file "%s" because "%s" (%s)' % \
-                             (src_file, reason, info['login_name']))
-        raise CopyFileError('Unable to copy file')
-    logging.debug('Copied file "%s" -> "%s" (%s)' % \
-                      (src_file, dst_file, info['login_name']))
-    return _initialize(req, info)
+        manage_users._padlock(stats_file, 'unlock')
+        logging.warn('Unable to count the copy because "%s" (%s)' % \
+                         (reason, info['login_name']))
+    return
+
+
+def _render_new_entry(id_file, info):
+    """Render the file manager entry of a file just added by the user.
+
+       entry = _render_new_entry(id_file, info)
+
+    Returns a string.
+    """
+    import catalog
+    import manage_kbasix
+    prefs = manage_kbasix._account_info(info['login_name'], 'prefs')
+    _entry_template(info, prefs)
+    info['toggle_select'] = ''
+    details = catalog._read_meta(id_file)
+    for i in ['file_title', 'file_description']:
+        if not details[i]: details[i] = info['empty_placeholder_']
+    return _render_entry(details, info)
 
 
 def _download_file(req, info):
@@ -722,12 +1266,13 @@ def _download_file(req, info):
     import aux
     file_tag = req.form['file_tag'].value
     _check_file_tag(file_tag, info['login_name'])
-    file_info = _get_file_info(file_tag, info)
+    file_info = _get_file_meta(file_tag, info)
     denied_page = _check_permissions(file_info, info)
     if denied_page:
         return denied_page
-    the_file = os.path.join(info['users_root_dir_'], str(info['uid']), \
-                                file_tag)
+    # GID and local shares are not linked into the user's directory (see
+    # '_file_path').
+    the_file = _file_path(file_tag, info)
     logging.debug('Downloading file "%s" (%s)' % \
                       (the_file, info['login_name']))
     if not os.access(the_file, os.R_OK):
@@ -853,6 +1398,14 @@ connection.'
             info['details'] = '[SYS] Error deleting files [%s].' % \
                 info['error_blurb_']
             return _fill_page(info['error_page_'], info)
+    elif req.form['action'] == 'changes':
+        try:
+            return _changes(req, info)
+        except Exception as reason:
+            logging.critical(reason)
+            info['details'] = '[SYS] File manager error [%s].' % \
+                info['error_blurb_']
+            return _fill_page(info['error_page_'], info)
     elif req.form['action'] == 'download':
         try:
             return _download_file(req, info)
@@ -0,0 +1,358 @@
+"""
+The background jobs of the KBasix CMS.
+Created by: Pamela Brittain
+            James Colliander
+            Marco De la Cruz-Heredia
+            Emile LeBlanc
+Coded by: Marco De la Cruz-Heredia (marco@math.utoronto.ca)
+
+Copyright (c) 2012, Department of Mathematics, University of Toronto
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice,
+   this list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+POSSIBILITY OF SUCH DAMAGE.
+"""
+
+_VERSION = 0.10
+
+import os
+from manage_users import _read_file, _save_file, _padlock
+from defs import kbasix, jobs
+
+
+class EnqueueError(Exception): pass
+class RunJobError(Exception): pass
+class UnknownTaskError(Exception): pass
+
+
+for key in kbasix:
+    vars()[key] = kbasix[key]
+for key in jobs:
+    vars()[key] = jobs[key]
+
+
+"""
+Work which can wait until after a file is stored (e.g. working out its
+type, previews, text extraction) is queued instead of done while the
+user waits for the upload page. A job is a small JSON file naming the
+file and the tasks to run on it, e.g.:
+
+  {"uid": 1001, "file_tag": "1345131658.602529-60f6...-file",
+   "login_name": "jane", "tasks": ["magic_type"], "attempts": 0}
+
+Jobs are written to 'new' under 'jobs_dir_' (see '_enqueue'), and a
+worker claims one by renaming it into 'work' (so two workers never get
+the same job). Each task returns the metadata it found, which is saved
+into the -file-id and bumped in the catalog (see '_run_job'). A job
+which fails is put back, not to be run again before 'retry_delay'
+seconds (doubling with every attempt), until it has been tried
+'max_attempts' times, then it is moved to 'failed'. Jobs which can
+never run (unknown tasks, unreadable job files) are moved there
+straight away. Jobs claimed by workers which died are put back every
+'recover_interval' seconds. The workers run outside of Apache, as the
+same user, e.g. from an init script or a crontab entry:
+
+  @reboot cd /www/kbasix/web/cms && python jobs.py
+
+('python jobs.py once' runs the jobs waiting and exits.) New tasks are
+functions added to '_tasks' below, and are queued for each upload by
+listing them in 'upload['post_upload_tasks']' (defs.py).
+"""
+
+
+def _task_magic_type(file_out, id_info):
+    """Determine the type of a file from its contents.
+
+       meta = _task_magic_type(file_out, id_info)
+
+    Returns a dictionary (the metadata to update).
+    """
+    import upload
+    return {'magic_type': upload._magic_type(file_out)}
+
+
+_tasks = {'magic_type': _task_magic_type}
+
+
+def _job_dir(state):
+    """Find a directory of the job queue (creating it if needed).
+
+       the_dir = _job_dir(state)
+
+    The 'state' is one of 'new', 'work' or 'failed'. Returns a string
+    (full path).
+    """
+    the_dir = os.path.join(jobs_dir_, state)
+    if not os.path.isdir(the_dir):
+        try:
+            os.makedirs(the_dir, 0700)
+        except OSError:
+            # Another process got there first.
+            if not os.path.isdir(the_dir):
+                raise
+    return the_dir
+
+
+def _enqueue(job):
+    """Queue a job.
+
+       _enqueue(job)
+
+    The 'job' is a dictionary with the 'uid', 'file_tag', 'login_name'
+    and 'tasks'. It is written out under a temporary name and renamed
+    into place, so that workers never see half a job. Returns nothing.
+    """
+    import time
+    import json
+    import hashlib
+    try:
+        job = dict(job)
+        job['attempts'] = 0
+        new_dir = _job_dir('new')
+        # Oldest first: the names sort by time.
+        name = '%017.6f-%s.job' % \
+            (time.time(), hashlib.sha1(os.urandom(16)).hexdigest())
+        tmp_file = os.path.join(new_dir, '.' + name)
+        f = open(tmp_file, 'wb')
+        try:
+            json.dump(job, f)
+        finally:
+            f.close()
+        os.rename(tmp_file, os.path.join(new_dir, name))
+    except Exception as reason:
+        raise EnqueueError('Unable to queue job because "%s": %s' % \
+                               (reason, job))
+    return
+
+
+def _run_job(job):
+    """Run the tasks of a job and save what they found in the metadata of
+    its file.
+
+       _run_job(job)
+
+    Jobs whose file has since been deleted are dropped. Raises
+    UnknownTaskError if a task is unknown (before any is run), and
+    RunJobError if one fails (none of the results are saved then).
+    Returns nothing.
+    """
+    import cgi
+    import logging
+    import catalog
+    file_out = os.path.join(users_root_dir_, str(job['uid']), \
+                                job['file_tag'])
+    id_file = file_out + '-id'
+    if not os.path.isfile(id_file):
+        logging.info('Dropping job for deleted file "%s" (%s)' % \
+                         (file_out, job['login_name']))
+        return
+    # Retrying won't make an unknown task known.
+    for task in job['tasks']:
+        if task not in _tasks:
+            raise UnknownTaskError('Unknown task "%s" for "%s" (%s)' % \
+                                       (task, file_out, job['login_name']))
+    meta = {}
+    for task in job['tasks']:
+        try:
+            meta.update(_tasks[task](file_out, _read_file(id_file, \
+                                                             lock=False)))
+        except Exception as reason:
+            raise RunJobError('Task "%s" failed for "%s" because "%s" \
+(%s)' % (task, file_out, reason, job['login_name']))
+    for key in meta:
+        if isinstance(meta[key], basestring):
+            # We should use html.escape when migrating to python3
+            meta[key] = cgi.escape(meta[key], True)
+    try:
+        _padlock(id_file, 'lock')
+        if not os.path.isfile(id_file):
+            _padlock(id_file, 'unlock')
+            return
+        id_info = _read_file(id_file, lock=False)
+        id_info.update(meta)
+        _save_file(id_info, id_file, backup=False)
+    except Exception as reason:
+        _padlock(id_file, 'unlock')
+        raise RunJobError('Unable to save the metadata of "%s" because \
+"%s" (%s)' % (file_out, reason, job['login_name']))
+    catalog._bump(job['uid'], [job['file_tag']])
+    # Sharees see the changes too.
+    if id_info['uid_shares'] or id_info['gid_shares'] or \
+            id_info['local_share']:
+        catalog._bump('shared', [job['file_tag']])
+    logging.debug('Ran "%s" for "%s" (%s)' % \
+                      ('", "'.join(job['tasks']), file_out, \
+                           job['login_name']))
+    return
+
+
+def _claim():
+    """Claim the oldest job which is due.
+
+       (job, work_file) = _claim()
+
+    Job files which can't be read are given up on (see '_give_up').
+    Returns a (dictionary, string) tuple, (None, None) if there are no
+    jobs due.
+    """
+    import json
+    import time
+    new_dir = _job_dir('new')
+    work_dir = _job_dir('work')
+    now = time.time()
+    for name in sorted(os.listdir(new_dir)):
+        if name.startswith('.'):
+            continue
+        # The names start with the time the job is due (see '_requeue'),
+        # so the rest are not due either.
+        if float(name.split('-', 1)[0]) > now:
+            break
+        # The pid lets jobs of dead workers be found (see '_recover').
+        work_file = os.path.join(work_dir, '%s-%s' % (os.getpid(), name))
+        try:
+            os.rename(os.path.join(new_dir, name), work_file)
+        except OSError:
+            # Claimed by another worker.
+            continue
+        try:
+            f = open(work_file, 'rb')
+            try:
+                return (json.load(f), work_file)
+            finally:
+                f.close()
+        except Exception as reason:
+            # Otherwise the worker would die on it again and again.
+            _give_up(work_file, 'Unable to read job because "%s"' % reason)
+    return (None, None)
+
+
+def _requeue(job, work_file, reason):
+    """Put a failed job back in the queue (or give up on it).
+
+       _requeue(job, work_file, reason)
+
+    Returns nothing.
+    """
+    import json
+    import time
+    import logging
+    job['attempts'] += 1
+    name = os.path.basename(work_file).split('-', 1)[1]
+    if job['attempts'] < max_attempts:
+        state = 'new'
+        # Backing off gives passing troubles time to clear.
+        job['not_before'] = time.time() + \
+            retry_delay * 2 ** (job['attempts'] - 1)
+        name = '%017.6f-%s' % (job['not_before'], name.split('-', 1)[1])
+    else:
+        state = 'failed'
+    f = open(work_file, 'wb')
+    try:
+        json.dump(job, f)
+    finally:
+        f.close()
+    os.rename(work_file, os.path.join(_job_dir(state), name))
+    logging.error('Job "%s" failed (attempt %s, now %s): %s' % \
+                      (name, job['attempts'], state, reason))
+    return
+
+
+def _give_up(work_file, reason):
+    """Move a claimed job which can never run to 'failed'.
+
+       _give_up(work_file, reason)
+
+    Returns nothing.
+    """
+    import logging
+    name = os.path.basename(work_file).split('-', 1)[1]
+    os.rename(work_file, os.path.join(_job_dir('failed'), name))
+    logging.error('Gave up on job "%s": %s' % (name, reason))
+    return
+
+
+def _recover():
+    """Put back the jobs claimed by workers which are no longer running.
+
+       _recover()
+
+    Returns nothing.
+    """
+    import errno
+    import logging
+    work_dir = _job_dir('work')
+    for name in os.listdir(work_dir):
+        (pid, job_name) = name.split('-', 1)
+        try:
+            os.kill(int(pid), 0)
+            continue
+        except OSError as reason:
+            if reason.errno != errno.ESRCH:
+                continue
+        try:
+            os.rename(os.path.join(work_dir, name), \
+                          os.path.join(_job_dir('new'), job_name))
+            logging.warn('Recovered job "%s" of worker %s' % \
+                             (job_name, pid))
+        except OSError:
+            pass
+    return
+
+
+def _work(once=False):
+    """Run queued jobs, waiting for more unless 'once' is True.
+
+       _work(once=False)
+
+    Returns nothing.
+    """
+    import time
+    import logging
+    recovered = 0
+    while True:
+        if time.time() - recovered >= recover_interval:
+            _recover()
+            recovered = time.time()
+        (job, work_file) = _claim()
+        if job is None:
+            if once:
+                return
+            time.sleep(poll_interval)
+            continue
+        try:
+            _run_job(job)
+        except UnknownTaskError as reason:
+            _give_up(work_file, reason)
+            continue
+        except Exception as reason:
+            _requeue(job, work_file, reason)
+            continue
+        os.remove(work_file)
+
+
+if __name__ == '__main__':
+    import sys
+    import logging
+    logging.basicConfig(level = getattr(logging, log_level_.upper()), \
+                            filename = log_file_, \
+                            datefmt = log_dateformat_, \
+                            format = log_format_)
+    _work(once = sys.argv[1:] == ['once'])
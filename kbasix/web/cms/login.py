@@ -69,6 +69,7 @@ def _login(req, info):
     import manage_kbasix
     import time
     import aux
+    import catalog
     from mod_python import util
     logging.debug('Starting login process for "%s"' % info['login_name'])
     if '*' in info['allowed_internal_logins'] or \
@@ -130,6 +131,25 @@ status/uid: %s' % (info['login_name'], is_usr, status))
             manage_kbasix._account_mod(info['login_name'], \
                                            'profile', {'last_login': \
                                                            time.time()})
+            # Clear out the share links and metadata layout of earlier
+            # versions (these are no-ops once done).
+            try:
+                manage_kbasix._unlink_gidloc_shares(info['login_name'])
+            except Exception as reason:
+                logging.error('Unable to remove share links because "%s" \
+(%s)' % (reason, info['login_name']))
+            try:
+                manage_kbasix._split_metadata(info['login_name'])
+            except Exception as reason:
+                logging.error('Unable to split metadata because "%s" \
+(%s)' % (reason, info['login_name']))
+            # The space usage is kept up to date as files come and go,
+            # but is recounted now and then in case it drifted.
+            try:
+                catalog._count_usage(uid)
+            except Exception as reason:
+                logging.error('Unable to count space usage because "%s" \
+(%s)' % (reason, info['login_name']))
             logging.info('Successful login from %s (%s)' % \
                              (req.get_remote_host(apache.REMOTE_NOLOOKUP), \
                                   info['login_name']))
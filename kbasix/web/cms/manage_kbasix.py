@@ -37,7 +37,7 @@ import time
 import os
 import hashlib
 import fnmatch
-from manage_users import _read_file, _save_file, _info
+from manage_users import _read_file, _save_file, _info, _padlock
 from defs import kbasix
 
 
@@ -50,6 +50,8 @@ class AccountDelError(Exception): pass
 class AccountModError(Exception): pass
 class AccountInfoError(Exception): pass
 class FingerError(Exception): pass
+class UnlinkSharesError(Exception): pass
+class SplitMetadataError(Exception): pass
 
 
 for key in kbasix:
@@ -396,8 +398,16 @@ def _account_del(login_name, wipe=False):
         try:
             import shutil
             shutil.rmtree(user_dir)
+            # The content only this user had is no longer needed.
+            if blob_store:
+                import blobs
+                blobs._collect()
         except Exception as reason:
             raise AccountDelError(reason)
+    # The files shared by this user may vanish from other listings (see
+    # 'exusers_cannot_share').
+    import catalog
+    catalog._bump('shared', kind='reset')
     return
 
 
@@ -425,6 +435,114 @@ def _account_info(login_name, ext):
         raise AccountInfoError(reason)
 
 
+def _unlink_gidloc_shares(login_name):
+    """Remove the local- and GID-share symlinks from a user's directory.
+
+       _unlink_gidloc_shares(login_name)
+
+    Local and GID shares used to be symlinked into every sharee's
+    directory, but they are now listed straight from 'shared_dir_' (see
+    'file_manager._get_entries'). The left-over links (and any broken
+    one-to-one share links) are removed, which is only done once per
+    user: it is recorded in the user's preferences. Returns nothing.
+    """
+    (OK, status) = _check_args(locals())
+    if not OK:
+        raise UnlinkSharesError(status)
+    import logging
+    import catalog
+    user_info = _info(login_name)
+    if not user_info:
+        return
+    uid = str(user_info['uid'])
+    user_dir = os.path.join(users_root_dir_, uid)
+    prefs_file = os.path.join(user_dir, uid + '.prefs')
+    try:
+        prefs = _read_file(prefs_file)
+    except Exception as reason:
+        raise UnlinkSharesError(reason)
+    if 'shares' in prefs and 'unlinked' in prefs['shares']:
+        _padlock(prefs_file, 'unlock')
+        return
+    shared_rpath = os.path.relpath(shared_dir_, user_dir)
+    changed = False
+    try:
+        for i in fnmatch.filter(os.listdir(user_dir), '*-file'):
+            dst = os.path.join(user_dir, i)
+            # Files owned by the user are left alone, as are the
+            # one-to-one shares which still point somewhere.
+            if not os.path.islink(dst) or \
+                    (not os.readlink(dst).startswith(shared_rpath) and \
+                         os.path.exists(dst)):
+                continue
+            for j in [dst, dst + '-id']:
+                if os.path.islink(j):
+                    os.remove(j)
+            changed = True
+            logging.debug('Removed shared file link "%s" (%s)' % \
+                              (dst, login_name))
+    except Exception as reason:
+        _padlock(prefs_file, 'unlock')
+        raise UnlinkSharesError(reason)
+    prefs['shares'] = {'unlinked': time.time()}
+    try:
+        _save_file(prefs, prefs_file)
+    except Exception as reason:
+        raise UnlinkSharesError(reason)
+    if changed:
+        catalog._bump(user_info['uid'], kind='reset')
+    return
+
+
+def _split_metadata(login_name):
+    """Move the custom metadata of a user's files into files of their
+    own (see 'catalog._split_custom').
+
+       _split_metadata(login_name)
+
+    This is only done once per user: it is recorded in the user's
+    preferences. Returns nothing.
+    """
+    (OK, status) = _check_args(locals())
+    if not OK:
+        raise SplitMetadataError(status)
+    import logging
+    import catalog
+    user_info = _info(login_name)
+    if not user_info:
+        return
+    uid = str(user_info['uid'])
+    user_dir = os.path.join(users_root_dir_, uid)
+    prefs_file = os.path.join(user_dir, uid + '.prefs')
+    try:
+        prefs = _read_file(prefs_file)
+    except Exception as reason:
+        raise SplitMetadataError(reason)
+    if 'metadata' in prefs and 'split' in prefs['metadata']:
+        _padlock(prefs_file, 'unlock')
+        return
+    n = 0
+    try:
+        for i in fnmatch.filter(os.listdir(user_dir), '*-file-id'):
+            id_file = os.path.join(user_dir, i)
+            # Shared files are split by their owners.
+            if os.path.islink(id_file):
+                continue
+            if catalog._split_custom(id_file):
+                n += 1
+    except Exception as reason:
+        _padlock(prefs_file, 'unlock')
+        raise SplitMetadataError(reason)
+    prefs['metadata'] = {'split': time.time()}
+    try:
+        _save_file(prefs, prefs_file)
+    except Exception as reason:
+        raise SplitMetadataError(reason)
+    logging.debug('Split the custom metadata of %s files (%s)' % \
+                      (n, login_name))
+    return
+
+
 def _finger(login_name):
     """Interactively retrieve information about a user account.
 
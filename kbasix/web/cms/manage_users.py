@@ -673,6 +673,27 @@ def _info(account_id, is_type='account'):
         return info
 
 
+def _ids(is_type='account'):
+    """Retrieve the numeric ids of all the users or of all the groups.
+
+       ids = _ids(is_type='account')
+
+    This is a single read of the accounts (or groups) file, meant for
+    when many ids need checking at once (e.g. the owners of the files in
+    a listing), instead of one '_info' call per id. If 'is_type' is
+    'account' the uids are returned, if 'group' the gids. Return is a
+    set (possibly an empty one).
+    """
+    (OK, status) = _check_args(locals())
+    if not OK:
+        return set()
+    (json_file, num_id, str_id, status) = _get_type(is_type)
+    if status != 'OK':
+        return set()
+    data = _read_file(json_file, lock = False)
+    return set([data[key][num_id] for key in data])
+
+
 def _finger(account_id='', is_type='account'):
     """Interactively retrieve information about a user or a group.
 
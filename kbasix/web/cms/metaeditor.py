@@ -46,6 +46,7 @@ def _initialize(req, info):
     """
     import logging
     import aux
+    import catalog
     import file_manager
     file_info = file_manager._get_file_info(info['file_tag'], info)
     # If 'file_info' is empty then that file has been unshared from
@@ -98,8 +99,8 @@ def _initialize(req, info):
     #                     with registered users/world.
     #   custom metadata: metadata created by the user.
     # Note that basic is just an arbitrary distinction, whilst custom is
-    # stored under a different key (file_info['custom']). Basic metadata
-    # is defined by metaeditor['basic_meta'] in defs.py.
+    # stored in a file of its own (see 'catalog._read_custom'). Basic
+    # metadata is defined by metaeditor['basic_meta'] in defs.py.
     #
     # The 'meta_template_' is the template defined in defs.py which
     # controls the information and layout of the entry.
@@ -116,16 +117,29 @@ def _initialize(req, info):
             data['value'] = value
         data.update(info['basic_meta'][key])
         info['basic_data'] += aux._fill_str(info['meta_template_'], data)
-    info['custom_data'] = ''
-    for key, value in file_info['custom'].items():
+    info['file_name'] = file_info['file_name']
+    # There is no limit on the amount of custom metadata, so it is
+    # streamed.
+    custom = catalog._read_custom(_id_file(info['file_tag'], info))
+    return aux._send_page(req, info['metaeditor_page_'], info, \
+                              'custom_data', _iter_custom_data(custom, info))
+
+
+def _iter_custom_data(custom, info):
+    """Render the custom metadata of a file one entry at a time.
+
+       for entry in _iter_custom_data(custom, info): ...
+
+    Returns a generator (of strings).
+    """
+    import aux
+    for key, value in custom.items():
         data = {}
         data['key'] = key
         data['name'] = key
         data['value'] = value
         data['help'] = ''
-        info['custom_data'] += aux._fill_str(info['meta_template_'], data)
-    info['file_name'] = file_info['file_name']
-    return aux._fill_page(info['metaeditor_page_'], info)
+        yield aux._fill_str(info['meta_template_'], data)
 
 
 def _get_shares(file_info, info):
@@ -201,18 +215,28 @@ def _save_file_info(file_info, file_tag, info, lock=False, backup=False):
     Returns nothing.
     """
     import logging
-    import os
-    import file_manager
     import manage_users
-    file_manager._check_file_tag(file_tag, info['login_name'])
-    id_file = os.path.join(info['users_root_dir_'], str(info['uid']), \
-                               file_tag) + '-id'
+    id_file = _id_file(file_tag, info)
     manage_users._save_file(file_info, id_file, lock, backup)
     logging.debug('Saved metadata file "%s" (%s)' % \
                       (id_file, info['login_name']))
     return
 
 
+def _id_file(file_tag, info):
+    """Find the metadata file of a file owned by the user.
+
+       id_file = _id_file(file_tag, info)
+
+    Returns a string (full path).
+    """
+    import os
+    import file_manager
+    file_manager._check_file_tag(file_tag, info['login_name'])
+    return os.path.join(info['users_root_dir_'], str(info['uid']), \
+                            file_tag) + '-id'
+
+
 def _update(req, info):
     """Update the metadata.
 
@@ -223,6 +247,7 @@ def _update(req, info):
     import logging
     import aux
     import cgi
+    import catalog
     import file_manager
     info['file_tag'] = req.form['file_tag'].value
     logging.debug('Updating metadata of "%s" (%s)' % \
@@ -243,6 +268,14 @@ def _update(req, info):
     if not file_info or file_info['owner_uid'] != info['uid']:
         raise UpdateError('Invalid file ownership "%s" (%s)' % \
                               (info['file_tag'], info['login_name']))
+    shared = file_info['uid_shares'] or file_info['gid_shares'] or \
+        file_info['local_share']
+    id_file = _id_file(info['file_tag'], info)
+    custom = catalog._read_custom(id_file)
+    # Metadata read before the custom metadata was split off still has
+    # it (see 'catalog._split_custom').
+    if 'custom' in file_info:
+        del file_info['custom']
     info['details'] = ''
     form_dict = req.form
     if 'local_share' not in form_dict:
@@ -281,8 +314,8 @@ def _update(req, info):
                 info['details'] += err
             else:
                 file_info[key] = val
-        elif key in file_info['custom']:
-            file_info[key] = val
+        elif key in custom:
+            custom[key] = val
         elif key in ['token', 'file_tag', 'action']:
             pass
         else:
@@ -297,6 +330,13 @@ def _update(req, info):
             logging.warn('Ignoring unknown key pair "%s: %s" (%s)' % \
                              (key, val, info['login_name']))
     _save_file_info(file_info, info['file_tag'], info)
+    if custom:
+        catalog._save_custom(custom, id_file)
+    catalog._bump(info['uid'], [info['file_tag']])
+    # Sharees see the changes too.
+    if shared or file_info['uid_shares'] or file_info['gid_shares'] or \
+            file_info['local_share']:
+        catalog._bump('shared', [info['file_tag']])
     logging.debug('Successful metadata update (%s)' % info['login_name'])
     info['class'] = 'success'
     info['details'] += aux._fill_str(info['successful_update_blurb'], info)
@@ -390,6 +430,23 @@ def _del_point_share_links(shared_path_dst, file_tag):
     return
 
 
+def _unshare(file_info, info):
+    """Remove all the shares of a file (e.g. prior to its deletion).
+
+       _unshare(file_info, info)
+
+    Returns nothing.
+    """
+    info['file_tag'] = file_info['file_tag']
+    for key in ['uid_shares', 'gid_shares']:
+        if file_info[key]:
+            _set_point_shares(file_info[key], '', key, info)
+    for key in ['local_share', 'world_share']:
+        if file_info[key]:
+            _set_wide_share(file_info[key], '', key, info)
+    return
+
+
 def _set_point_shares(old_ids, new_shares, shares_type, info):
     """Set the point shares (with individual users).
 
@@ -401,6 +458,7 @@ def _set_point_shares(old_ids, new_shares, shares_type, info):
     """
     import logging
     import os
+    import catalog
     import manage_users
     # We convert the 'new_shares' string into a list of uids/gids.
     (new_ids, err) = _parse_shares(new_shares, shares_type, info)
@@ -420,6 +478,7 @@ def _set_point_shares(old_ids, new_shares, shares_type, info):
                 shared_path_dst = os.path.join(info['users_root_dir_'], \
                                                    str(uid))
                 _del_point_share_links(shared_path_dst, info['file_tag'])
+                catalog._bump(uid, [info['file_tag']], 'removed')
         for uid in new_ids:
             shared_path_dst = os.path.join(info['users_root_dir_'], \
                                                str(uid))
@@ -429,6 +488,7 @@ def _set_point_shares(old_ids, new_shares, shares_type, info):
             else:
                 _make_point_share_links(shared_path_src, shared_path_dst, \
                                             info['file_tag'])
+                catalog._bump(uid, [info['file_tag']], 'added')
     # New group shares have symlinks created in the appropriate group
     # directories. These directories are created if they don't exist
     # already. They are identified by GID, so if a group is deleted
@@ -455,6 +515,12 @@ def _set_point_shares(old_ids, new_shares, shares_type, info):
                     os.chmod(shared_path_dst, 0700)
                 _make_point_share_links(shared_path_src, shared_path_dst, \
                                             info['file_tag'])
+        # Those who cannot see the file ignore these (see 'changes' in
+        # file_manager.py).
+        if [gid for gid in old_ids if gid not in new_ids]:
+            catalog._bump('shared', [info['file_tag']], 'removed')
+        if [gid for gid in new_ids if gid not in old_ids]:
+            catalog._bump('shared', [info['file_tag']], 'added')
     return (new_ids, err)
 
 
@@ -468,6 +534,7 @@ def _set_wide_share(old_share, new_share, share_type, info):
     """
     import logging
     import os
+    import catalog
     if new_share == old_share:
         logging.debug('Share of type "%s" was unchanged (%s)' % \
                           (share_type, info['login_name']))
@@ -513,6 +580,13 @@ def _set_wide_share(old_share, new_share, share_type, info):
             os.symlink(shared_file_src + '-id', shared_file_dst + '-id')
         logging.debug('Share of type "%s" was added (%s)' % \
                           (share_type, info['login_name']))
+    # Registered users list the local shares straight from the shared
+    # directory (world shares do not show up in the file manager).
+    if share_type == 'local_share':
+        if new_share:
+            catalog._bump('shared', [info['file_tag']], 'added')
+        else:
+            catalog._bump('shared', [info['file_tag']], 'removed')
     return new_share
 
 
@@ -33,7 +33,18 @@ POSSIBILITY OF SUCH DAMAGE.
 
 _VERSION = 0.10
 
+import threading
+
+
 class GetFileError(Exception): pass
+class ArchiveError(Exception): pass
+
+
+# The libmagic handle, loaded once per Apache child (loading parses the
+# whole magic database) and shared by the uploads it serves (see
+# '_magic_type'). The lock is made here, once, so that two threads can't
+# both find the handle missing and race to load it.
+_magic = {'handle': None, 'lock': threading.Lock()}
 
 
 def _initialize(req, info):
@@ -67,7 +78,7 @@ def _fbuffer(f, chunk_size=2**16):
     Returns data chunk generator. See also:
        http://stackoverflow.com/questions/231767/the-python-yield-keyword-explained
     Read the comments in '_get_file' for an explanation of the magic
-    number.
+    number (the uploads use 'chunk_size' from defs.py instead).
     """
     while True:
         chunk = f.read(chunk_size)
@@ -75,6 +86,80 @@ def _fbuffer(f, chunk_size=2**16):
         yield chunk
 
 
+class _Hasher(object):
+    """Compute several digests of a file in one pass.
+
+       hasher = _Hasher(names, threaded=False)
+
+    The 'names' are those known to hashlib (e.g. 'md5', 'sha256'). Each
+    chunk passed to 'update' is fed to all the digests. If 'threaded'
+    is True the hashing is done by a worker thread, so that it overlaps
+    with the writing of the file (hashlib lets go of the GIL on large
+    chunks). 'close' must always be called, even on failure, so that
+    the thread ends ('hexdigests' calls it).
+    """
+
+    def __init__(self, names, threaded=False):
+        import hashlib
+        import threading
+        import Queue
+        self.digests = [(i, hashlib.new(i)) for i in names]
+        self.queue = None
+        if threaded:
+            # The queue is bounded so that a slow hash holds back the
+            # upload instead of piling up chunks in memory.
+            self.queue = Queue.Queue(8)
+            self.thread = threading.Thread(target=self._work)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def _work(self):
+        while True:
+            chunk = self.queue.get()
+            if chunk is None:
+                break
+            for (name, digest) in self.digests:
+                digest.update(chunk)
+
+    def update(self, chunk):
+        if self.queue:
+            self.queue.put(chunk)
+        else:
+            for (name, digest) in self.digests:
+                digest.update(chunk)
+
+    def close(self):
+        if self.queue:
+            self.queue.put(None)
+            self.thread.join()
+            self.queue = None
+
+    def hexdigests(self):
+        """Finish hashing.
+
+           digests = hasher.hexdigests()
+
+        Returns a dictionary of name: hex digest.
+        """
+        self.close()
+        return dict([(name, digest.hexdigest()) for (name, digest) in \
+                         self.digests])
+
+
+def _digest_names(info):
+    """List the digests kept of the files ('md5' always is, since
+    'file_md5sum' is part of the core metadata).
+
+       names = _digest_names(info)
+
+    Returns a list.
+    """
+    names = list(info['digests'])
+    if 'md5' not in names:
+        names.insert(0, 'md5')
+    return names
+
+
 def _get_file(req, info):    
     """Upload a file (-file) and create its associate metadata (-file-id)
     file.
@@ -84,11 +169,10 @@ def _get_file(req, info):
     Returns the KBasix upload status page.
     """
     import os
-    import cgi
     import time
     import hashlib
-    import json
     import aux
+    import catalog
     import logging
     from mod_python import apache
     # Definitions.
@@ -117,87 +201,83 @@ def _get_file(req, info):
     file_out = os.path.join(info['users_root_dir_'], str(info['uid']), \
                                 file_tag)
     id_file = file_out + '-id'
-    fileitem = req.form['file_name']
-    # In order to substitute this value into the message strings it must
-    # be decoded.
-    file_in = fileitem.filename.decode('utf-8')
+    # Browsers may send several files at once (see "multiple" in
+    # upload.html), all under the same field name.
+    fileitems = [i for i in req.form.getlist('file_name') if i.filename]
+    if fileitems:
+        fileitem = fileitems[0]
+        # In order to substitute this value into the message strings it
+        # must be decoded.
+        file_in = fileitem.filename.decode('utf-8')
+    else:
+        file_in = ''
     if file_in:
-        d = hashlib.md5()
-        # Buffer size is set to 2^16, a magic number which seems OK,
+        # Buffer size was set to 2^16, a magic number which seems OK,
         # but should be justified (or changed). Upping to 2**24 didn't
-        # seem to make a difference. Note this also has to be changed
-        # in the _fbuffer function above.
+        # seem to make a difference. It is now 'chunk_size' in defs.py.
         # Browsers seem to be able to handle files up to 2GB in size.
         # Uploading a 2082168350b binary file on a 100Mb LAN took about
         # 4 minutes.
         # Progress bars are a no-go (for now?):
         #   http://www.mailinglistarchive.com/mod_python@modpython.org/msg01880.html
+        # The space is reserved up front, so that concurrent uploads
+        # (and copies) cannot together go over quota. The request is a
+        # bit larger than the file(s) it carries, so its declared size is
+        # enough (without it all the space left is reserved). A file
+        # which only fits without the rest of the form ('form_overhead')
+        # gets all the space left instead, and the writing stops if it
+        # turns out not to fit after all.
+        # An archive takes up more space once expanded, so it reserves
+        # all the space left.
+        try:
+            declared = int(req.headers_in['Content-Length'])
+        except:
+            declared = None
+        if 'expand_archive' in req.form:
+            declared = None
+        (reservation, limit) = \
+            catalog._reserve(info['uid'], declared, info['quota'])
+        if not reservation and declared is not None and \
+                declared - info['form_overhead'] <= limit:
+            (reservation, limit) = \
+                catalog._reserve(info['uid'], None, info['quota'])
+        if not reservation:
+            logging.info('Not enough quota left for "%s" (%s)' % \
+                             (file_in, info['login_name']))
+            return _over_quota_page(req, 'upload', info, \
+                                        info['quota_fit_blurb'])
+        if 'expand_archive' in req.form or len(fileitems) > 1:
+            return _get_files(req, info, fileitems, reservation, limit)
         logging.info('Starting to upload "%s" (%s)' % \
                          (file_out, info['login_name']))
         try:
-            f = open(file_out, 'wb', 2**16)
-            for chunk in _fbuffer(fileitem.file):
-                d.update(chunk)
-                f.write(chunk)
+            (written, digests, head) = \
+                _place(fileitem.file, file_out, limit, info)
         except Exception as reason:
+            catalog._release(info['uid'], reservation)
             logging.error('Unable to upload the file type because \
 "%s" (%s)' % (reason, info['login_name']))
             raise GetFileError('Upload failed, closing "%s"' % file_out)
-        finally:
-            f.close()
+        if written > limit:
+            os.remove(file_out)
+            catalog._release(info['uid'], reservation)
+            logging.info('Upload of "%s" outgrew the %s bytes reserved \
+(%s)' % (file_in, limit, info['login_name']))
+            return _over_quota_page(req, 'upload', info, \
+                                        info['quota_fit_blurb'])
         os.chmod(file_out, 0600)
         s = os.path.getsize(file_out)
-        # You can add to the "id_info" dictionary any other metadata
-        # you wish to save, but the following is the basic information
-        # all files will contain.
-        id_info = {}
-        id_info['owner'] = info['login_name']
-        id_info['owner_uid'] = info['uid']
-        id_info['uid_shares'] = []
-        id_info['gid_shares'] = []
-        id_info['local_share'] = False
-        id_info['world_share'] = False
-        id_info['timestamp'] = time.time()
-        id_info['file_title'] = req.form['file_title'].value
-        id_info['file_description'] = req.form['file_description'].value
-        file_type = req.form['file_type'].value
-        if file_type not in info['file_types']:
-            id_info['file_type'] = 'Unknown'
-        else:
-            id_info['file_type'] = file_type
-        id_info['file_name'] = file_in
-        id_info['file_md5sum'] = d.hexdigest()
-        id_info['file_size'] = s
-        id_info['file_tag'] = file_tag
-        # Documentation for python-magic seems non-existent, but it seems
-        # to be equivalent to the "file" command (which isn't that great).
-        try:
-            import magic
-            magic_type = magic.open(magic.MAGIC_NONE)
-            magic_type.load()
-            id_info['magic_type'] = magic_type.file(file_out)
-        except Exception as reason:
-            logging.error('Unable to determine the file type because \
-"%s" (%s)' % (reason, info['login_name']))
-            id_info['magic_type'] = 'Unknown'
-        id_info['custom'] = {}
-        for key in id_info:
-            if isinstance(id_info[key], basestring):
-                # We should use html.escape when migrating to python3
-                id_info[key] = cgi.escape(id_info[key], True)
+        fields = {'file_title': req.form['file_title'].value, \
+                      'file_description': \
+                      req.form['file_description'].value, \
+                      'file_type': req.form['file_type'].value, \
+                      'file_name': file_in}
         try:
-            f = open(id_file, 'wb')
-            json.dump(id_info, f)
-        except Exception as reason:
-            logging.error('Unable to create the metadata file because \
-"%s" (%s)' % (reason, info['login_name']))
-            if os.isfile(file_out):
-                os.remove(file_out)
-            raise GetFileError('Metadata creation failed, deleted upload \
-file "%s" and closing "%s"' % (file_out, id_file))
-        finally:
-            f.close()
-        os.chmod(id_file, 0600)
+            id_info = _save_id_file(file_out, fields, digests, info, head)
+        except:
+            catalog._release(info['uid'], reservation)
+            raise
+        catalog._bump(info['uid'], [file_tag], 'added', s, reservation)
         n = id_info['file_name']
         if s == 0:
             info['class'] = 'warning'
@@ -212,12 +292,24 @@ client-side unreadable)' % n
                                                      'type': \
                                                      id_info['file_type'], \
                                                      'size': s, \
-                                                     'md5': d.hexdigest()})
+                                                     'md5': \
+                                                     digests['md5']})
         logging.info('Finished uploading and saving "%s" (%s)' % \
                          (file_out, info['login_name']))
     else:
         info['class'] = 'fail'
         info['details'] = 'No file was specified.'
+    return _upload_status_page(info)
+
+
+def _upload_status_page(info):
+    """Make the page reporting on an upload.
+
+       page = _upload_status_page(info)
+
+    Returns a string (page).
+    """
+    import aux
     info['title'] = 'File Upload'
     # We don't use the usual "go back" button because it will show the
     # upload animation.
@@ -231,6 +323,899 @@ client-side unreadable)' % n
     return aux._fill_page(info['status_page_'], info)
 
 
+def _copy_hashed(src_file, dst_file, settings):
+    """Copy a file, taking its digests on the way (see '_Hasher').
+
+       digests = _copy_hashed(src_file, dst_file, settings)
+
+    The 'settings' are the upload ones from defs.py (the buffer size and
+    digests). The permissions and times are copied too (as by
+    'shutil.copy2'). Returns a dictionary of name: hex digest.
+    """
+    import shutil
+    hasher = _Hasher(_digest_names(settings), settings['threaded_hashing'])
+    chunk_size = settings['chunk_size']
+    try:
+        f_in = open(src_file, 'rb', chunk_size)
+        try:
+            f_out = open(dst_file, 'wb', chunk_size)
+            try:
+                for chunk in _fbuffer(f_in, chunk_size):
+                    hasher.update(chunk)
+                    f_out.write(chunk)
+            finally:
+                f_out.close()
+        finally:
+            f_in.close()
+    finally:
+        digests = hasher.hexdigests()
+    shutil.copystat(src_file, dst_file)
+    return digests
+
+
+def _hash_file(the_file, settings):
+    """Take the digests of a file (see '_Hasher').
+
+       digests = _hash_file(the_file, settings)
+
+    The 'settings' are as for '_copy_hashed'. Returns a dictionary of
+    name: hex digest.
+    """
+    hasher = _Hasher(_digest_names(settings), settings['threaded_hashing'])
+    try:
+        f = open(the_file, 'rb', settings['chunk_size'])
+        try:
+            for chunk in _fbuffer(f, settings['chunk_size']):
+                hasher.update(chunk)
+        finally:
+            f.close()
+    finally:
+        digests = hasher.hexdigests()
+    return digests
+
+
+# The Linux ioctl which clones a whole file (FICLONE in <linux/fs.h>).
+_FICLONE = 0x40049409
+
+
+def _reflink(src_file, dst_file):
+    """Copy a file by sharing its data blocks until either file is
+    changed (copy-on-write), on filesystems which support it (e.g.
+    btrfs, XFS).
+
+       cloned = _reflink(src_file, dst_file)
+
+    The permissions and times are copied too (see '_copy_hashed').
+    Returns a boolean (False if the file could not be cloned, in which
+    case nothing is left behind).
+    """
+    import os
+    import errno
+    import shutil
+    try:
+        import fcntl
+    except ImportError:
+        return False
+    cloned = False
+    f_in = open(src_file, 'rb')
+    try:
+        f_out = open(dst_file, 'wb')
+        try:
+            fcntl.ioctl(f_out.fileno(), _FICLONE, f_in.fileno())
+            cloned = True
+        except IOError as reason:
+            # Not supported by the filesystem (or kernel), or the files
+            # are on different filesystems.
+            if reason.errno not in [errno.EOPNOTSUPP, errno.ENOTTY, \
+                                        errno.EXDEV, errno.EINVAL, \
+                                        errno.ENOSYS, errno.EBADF]:
+                raise
+        finally:
+            f_out.close()
+    finally:
+        f_in.close()
+    if not cloned:
+        os.remove(dst_file)
+        return False
+    shutil.copystat(src_file, dst_file)
+    return True
+
+
+def _write_stream(stream, file_out, limit, info):
+    """Write out an uploaded file, taking its digests on the way (see
+    '_Hasher').
+
+       (written, digests, head) = _write_stream(stream, file_out, limit,
+                                                info)
+
+    Writing stops once more than 'limit' bytes (the space reserved) have
+    been read, in which case 'written' is larger than 'limit' and the
+    file is incomplete. Returns an (int, dict, str) tuple with the bytes
+    read, the hex digests and the first chunk (for '_magic_type').
+    """
+    written = 0
+    # All the digests are fed from the same buffer, rather than
+    # reading the file again for each of them.
+    hasher = _Hasher(_digest_names(info), info['threaded_hashing'])
+    head = ''
+    try:
+        f = open(file_out, 'wb', info['chunk_size'])
+        try:
+            for chunk in _fbuffer(stream, info['chunk_size']):
+                if not written:
+                    head = chunk
+                written += len(chunk)
+                # Nothing past the reserved space is written.
+                if written > limit:
+                    break
+                hasher.update(chunk)
+                f.write(chunk)
+        finally:
+            f.close()
+    finally:
+        digests = hasher.hexdigests()
+    return (written, digests, head)
+
+
+def _place(stream, file_out, limit, info):
+    """Put an uploaded file in place, taking its digests on the way (see
+    '_write_stream').
+
+       (written, digests, head) = _place(stream, file_out, limit, info)
+
+    Files spooled by 'upload_guard' are already written out and hashed,
+    so they are just renamed (unless the spool is on another filesystem,
+    in which case they are copied). Returns the same as '_write_stream'.
+    """
+    import os
+    import errno
+    if not hasattr(stream, 'place'):
+        return _write_stream(stream, file_out, limit, info)
+    try:
+        return stream.place(file_out)
+    except OSError as reason:
+        if reason.errno != errno.EXDEV:
+            raise
+    stream.seek(0)
+    return _write_stream(stream, file_out, limit, info)
+
+
+def _archive_members(archive):
+    """Go through the regular files of a zip or tar archive (possibly
+    compressed), without extracting them to disk.
+
+       members = _archive_members(archive)
+
+    The 'archive' is a file object. Zip archives need to be seekable
+    (their directory is at the end), tar archives are read as a stream.
+    Raises ArchiveError if it is neither. Returns a generator of (name,
+    file object) tuples.
+    """
+    import zipfile
+    import tarfile
+    try:
+        zf = zipfile.ZipFile(archive)
+    except zipfile.BadZipfile:
+        zf = None
+    if zf:
+        for member in zf.infolist():
+            if member.filename.endswith('/'):
+                continue
+            yield (member.filename, zf.open(member))
+        return
+    archive.seek(0)
+    try:
+        tf = tarfile.open(fileobj=archive, mode='r|*')
+        for member in tf:
+            if not member.isfile():
+                continue
+            yield (member.name, tf.extractfile(member))
+    except tarfile.TarError:
+        raise ArchiveError('The file is not a zip or tar archive.')
+
+
+def _get_files(req, info, fileitems, reservation, limit):
+    """Upload several files, or expand archives, into one file (-file
+    and -file-id) each.
+
+       page = _get_files(req, info, fileitems, reservation, limit)
+
+    Archive members are titled after their path in the archive and other
+    files after their name (after the title given, if any). All share
+    the description and type given. They are all added, and charged to
+    the quota, at once: if any of them fails (or they do not fit in the
+    'limit' reserved) none are kept. Returns the KBasix upload status
+    page, listing each file.
+    """
+    import os
+    import logging
+    import aux
+    import catalog
+    user_dir = os.path.join(info['users_root_dir_'], str(info['uid']))
+    expand = 'expand_archive' in req.form
+    title = req.form['file_title'].value.decode('utf-8')
+    names = [i.filename.decode('utf-8') for i in fileitems]
+    logging.info('Uploading %s file(s) "%s" (%s)' % \
+                     (len(names), '", "'.join(names), info['login_name']))
+    added = []
+    results = []
+    total = 0
+    error = ''
+    try:
+        for fileitem in fileitems:
+            if expand:
+                members = _archive_members(fileitem.file)
+            else:
+                members = [(fileitem.filename, fileitem.file)]
+            for (name, stream) in members:
+                if len(added) == info['upload_max_files']:
+                    error = 'More than %s files were sent.' % \
+                        info['upload_max_files']
+                    break
+                file_out = os.path.join(user_dir, _new_file_tag(info))
+                added.append(file_out)
+                (written, digests, head) = \
+                    _place(stream, file_out, limit - total, info)
+                if written > limit - total:
+                    error = aux._fill_str(info['quota_fit_blurb'], info)
+                    break
+                total += written
+                os.chmod(file_out, 0600)
+                # Zip members flagged as UTF-8 are unicode already.
+                if isinstance(name, str):
+                    name = name.decode('utf-8', 'replace')
+                if title:
+                    file_title = '%s (%s)' % (title, name)
+                else:
+                    file_title = name
+                fields = {'file_title': file_title, \
+                              'file_description': \
+                              req.form['file_description'].value, \
+                              'file_type': req.form['file_type'].value, \
+                              'file_name': os.path.basename(name)}
+                id_info = _save_id_file(file_out, fields, digests, info, \
+                                            head)
+                results.append((id_info, digests))
+            if error:
+                break
+    except ArchiveError as reason:
+        error = str(reason)
+    except:
+        _discard(added, info)
+        catalog._release(info['uid'], reservation)
+        raise
+    if error:
+        _discard(added, info)
+        catalog._release(info['uid'], reservation)
+        logging.info('Upload of "%s" dropped because "%s" (%s)' % \
+                         ('", "'.join(names), error, info['login_name']))
+        info['class'] = 'fail'
+        info['details'] = error
+        return _upload_status_page(info)
+    file_tags = [os.path.basename(i) for i in added]
+    catalog._bump(info['uid'], file_tags, 'added', total, reservation)
+    if not added:
+        info['class'] = 'warning'
+        info['details'] = 'No files found in "%s".' % '", "'.join(names)
+        return _upload_status_page(info)
+    info['class'] = 'success'
+    lines = [aux._fill_str(info['successful_files_'], \
+                               {'count': len(added), \
+                                    'size': aux._bytes_string(total)})]
+    for (id_info, digests) in results:
+        if id_info['file_size'] == 0:
+            info['class'] = 'warning'
+        s = aux._bytes_string(id_info['file_size'])
+        lines.append(aux._fill_str(info['successful_files_item_'], \
+                                       {'name': id_info['file_title'], \
+                                            'type': id_info['file_type'], \
+                                            'size': s, \
+                                            'md5': digests['md5']}))
+    info['details'] = '<br>'.join(lines)
+    logging.info('Finished uploading %s file(s) (%s)' % \
+                     (len(added), info['login_name']))
+    return _upload_status_page(info)
+
+
+def _discard(files, info):
+    """Delete files (and their metadata) added by an upload which
+    failed.
+
+       _discard(files, info)
+
+    Their content is also dropped from the blob store, unless other
+    files have it (see 'blobs._unref'). Returns nothing.
+    """
+    import os
+    import logging
+    import blobs
+    import manage_users
+    for i in files:
+        sha256 = None
+        if info['blob_store'] and os.path.isfile(i + '-id'):
+            try:
+                id_info = manage_users._read_file(i + '-id', lock=False)
+                sha256 = id_info['file_sha256sum']
+            except Exception:
+                pass
+        for j in [i, i + '-id']:
+            if os.path.isfile(j):
+                os.remove(j)
+        if sha256:
+            try:
+                blobs._unref(sha256)
+            except Exception as reason:
+                logging.warn(reason)
+    return
+
+
+def _new_file_tag(info):
+    """Make a new file tag (see '_get_file').
+
+       file_tag = _new_file_tag(info)
+
+    Returns a string.
+    """
+    import os
+    import time
+    import hashlib
+    return '%r-%s-file' % \
+        (time.time(), \
+             hashlib.sha256(os.urandom(info['random_length'])).hexdigest())
+
+
+def _magic_type(file_out, head=None):
+    """Determine the type of a file from its contents (like the "file"
+    command).
+
+       magic_type = _magic_type(file_out, head=None)
+
+    If given, 'head' (the first chunk of the file) is looked at instead
+    of reading the file again. Returns a string.
+    """
+    # Documentation for python-magic seems non-existent, but it seems
+    # to be equivalent to the "file" command (which isn't that great).
+    import magic
+    # A libmagic handle can't be used by two threads at once (nor loaded).
+    _magic['lock'].acquire()
+    try:
+        if _magic['handle'] is None:
+            handle = magic.open(magic.MAGIC_NONE)
+            handle.load()
+            _magic['handle'] = handle
+        if head is not None:
+            return _magic['handle'].buffer(head)
+        return _magic['handle'].file(file_out)
+    finally:
+        _magic['lock'].release()
+
+
+def _save_id_file(file_out, fields, digests, info, head=None):
+    """Create the metadata (-file-id) file of a file just added.
+
+       id_info = _save_id_file(file_out, fields, digests, info, head=None)
+
+    The 'fields' dictionary holds the user-supplied 'file_title',
+    'file_description', 'file_type' and 'file_name', and 'digests' the
+    hex digests of the file contents (see '_Hasher'), each of which is
+    stored as e.g. 'file_sha256sum'. The 'head' is the first chunk of
+    the file, if at hand (see '_magic_type'). On failure the file is
+    deleted and GetFileError raised. The 'post_upload_tasks' are then
+    queued (see jobs.py). Returns a dictionary (the metadata).
+    """
+    import os
+    import cgi
+    import time
+    import json
+    import logging
+    import jobs
+    import blobs
+    import catalog
+    import manage_users
+    file_tag = os.path.basename(file_out)
+    id_file = file_out + '-id'
+    # You can add to the "id_info" dictionary any other metadata
+    # you wish to save, but the following is the basic information
+    # all files will contain.
+    id_info = {}
+    id_info['owner'] = info['login_name']
+    id_info['owner_uid'] = info['uid']
+    id_info['uid_shares'] = []
+    id_info['gid_shares'] = []
+    id_info['local_share'] = False
+    id_info['world_share'] = False
+    id_info['timestamp'] = time.time()
+    id_info['file_title'] = fields['file_title']
+    id_info['file_description'] = fields['file_description']
+    if fields['file_type'] not in info['file_types']:
+        id_info['file_type'] = 'Unknown'
+    else:
+        id_info['file_type'] = fields['file_type']
+    id_info['file_name'] = fields['file_name']
+    for name in digests:
+        id_info['file_%ssum' % name] = digests[name]
+    id_info['file_size'] = os.path.getsize(file_out)
+    id_info['file_tag'] = file_tag
+    tasks = info['post_upload_tasks']
+    if 'magic_type' in tasks:
+        # Filled in by the background job (see below).
+        id_info['magic_type'] = 'Pending'
+    else:
+        try:
+            id_info['magic_type'] = _magic_type(file_out, head)
+        except Exception as reason:
+            logging.error('Unable to determine the file type because \
+"%s" (%s)' % (reason, info['login_name']))
+            id_info['magic_type'] = 'Unknown'
+    for key in id_info:
+        if isinstance(id_info[key], basestring):
+            # We should use html.escape when migrating to python3
+            id_info[key] = cgi.escape(id_info[key], True)
+    try:
+        f = open(id_file, 'wb')
+        json.dump(id_info, f)
+    except Exception as reason:
+        logging.error('Unable to create the metadata file because \
+"%s" (%s)' % (reason, info['login_name']))
+        if os.path.isfile(file_out):
+            os.remove(file_out)
+        raise GetFileError('Metadata creation failed, deleted upload \
+file "%s" and closing "%s"' % (file_out, id_file))
+    finally:
+        f.close()
+    os.chmod(id_file, 0600)
+    if info['blob_store'] and 'sha256' in digests:
+        try:
+            blobs._store(file_out, digests['sha256'])
+        except Exception as reason:
+            logging.error(reason)
+    if info['dedup'] and 'sha256' in digests:
+        try:
+            catalog._index_digest(digests['sha256'], info['uid'], file_tag)
+        except Exception as reason:
+            logging.error('Unable to index "%s" because "%s" (%s)' % \
+                              (file_out, reason, info['login_name']))
+    if tasks:
+        job = {'uid': info['uid'], 'file_tag': file_tag, \
+                   'login_name': info['login_name'], 'tasks': tasks}
+        try:
+            jobs._enqueue(job)
+        except Exception as reason:
+            # Better late than never.
+            logging.error('Running the post-upload tasks now because \
+"%s" (%s)' % (reason, info['login_name']))
+            try:
+                jobs._run_job(job)
+                id_info = manage_users._read_file(id_file, lock=False)
+            except Exception as reason:
+                logging.error(reason)
+    return id_info
+
+
+"""
+A client which knows the SHA-256 digest of a file can first check
+whether its content is already on the server (action=upload_by_hash,
+taking the 'file_sha256sum' and 'file_size', plus the fields of a
+normal upload). If it is, and the user can read a file with that
+content (their own, or one shared with them), the new file is linked to
+it (or, across filesystems, copied) without the content being sent, and
+the JSON reply holds its 'file_tag'. Otherwise the reply says 'found' is
+false and the file has to be uploaded as usual. The quota is charged as
+for any other upload. This is only done if 'dedup' is True (see
+'catalog._index_digest').
+"""
+
+
+def _find_content(sha256, size, info):
+    """Find a file the user can read which has the given content.
+
+       (the_file, id_info) = _find_content(sha256, size, info)
+
+    Returns a (string, dictionary) tuple with the path of the content
+    file and its metadata, (None, None) if there is none.
+    """
+    import os
+    import logging
+    import defs
+    import catalog
+    import file_manager
+    import manage_users
+    # Who can read what is up to the file manager settings.
+    reader = {}
+    reader.update(defs.file_manager)
+    reader.update(info)
+    for (uid, file_tag) in catalog._find_digest(sha256):
+        the_file = os.path.join(info['users_root_dir_'], str(uid), file_tag)
+        try:
+            id_info = manage_users._read_file(the_file + '-id', lock=False)
+        except:
+            id_info = None
+        if not id_info or not os.path.isfile(the_file):
+            catalog._unindex_digest(sha256, uid, file_tag)
+            continue
+        if id_info.get('file_sha256sum') != sha256 or \
+                id_info['file_size'] != size or \
+                os.path.getsize(the_file) != size:
+            continue
+        if id_info['world_share'] or \
+                file_manager._can_access(id_info, reader):
+            logging.debug('Content "%s" found in "%s" (%s)' % \
+                              (sha256, the_file, info['login_name']))
+            return (the_file, id_info)
+    return (None, None)
+
+
+def _upload_by_hash(req, info):
+    """Add a file from content already on the server.
+
+       return _upload_by_hash(req, info)
+
+    Returns a string (JSON).
+    """
+    import os
+    import errno
+    import logging
+    import aux
+    import catalog
+    import file_manager
+    if not info['dedup']:
+        return file_manager._partial_reply(req, info, {'found': False})
+    try:
+        size = int(req.form['file_size'].value)
+    except:
+        return file_manager._partial_reply(req, info, \
+                                               {'error': \
+                                                    'Invalid file size'})
+    try:
+        sha256 = req.form['file_sha256sum'].value.lower()
+        catalog._digest_file(sha256)
+    except:
+        return file_manager._partial_reply(req, info, \
+                                               {'error': 'Invalid digest'})
+    (src_file, src_info) = _find_content(sha256, size, info)
+    if not src_file:
+        return file_manager._partial_reply(req, info, {'found': False})
+    (reservation, limit) = catalog._reserve(info['uid'], size, info['quota'])
+    if not reservation:
+        info['user_dir_size'] = catalog._usage(info['uid'])
+        error = aux._fill_str(info['quota_fit_blurb'], info)
+        return file_manager._partial_reply(req, info, {'error': error})
+    file_tag = _new_file_tag(info)
+    file_out = os.path.join(info['users_root_dir_'], str(info['uid']), \
+                                file_tag)
+    # The stored digests are those of the very same content, but older
+    # files may lack some of them.
+    digests = {}
+    for name in _digest_names(info):
+        if 'file_%ssum' % name in src_info:
+            digests[name] = src_info['file_%ssum' % name]
+    try:
+        try:
+            os.link(src_file, file_out)
+        except OSError as reason:
+            if reason.errno not in [errno.EXDEV, errno.EPERM, \
+                                        errno.EMLINK]:
+                raise
+            digests = _copy_hashed(src_file, file_out, info)
+        if len(digests) < len(_digest_names(info)):
+            digests = _hash_file(file_out, info)
+        fields = {}
+        for key in ['file_title', 'file_description', 'file_type', \
+                        'file_name']:
+            if key in req.form:
+                fields[key] = req.form[key].value.decode('utf-8')
+            else:
+                fields[key] = ''
+        _save_id_file(file_out, fields, digests, info)
+    except:
+        catalog._release(info['uid'], reservation)
+        if os.path.isfile(file_out):
+            os.remove(file_out)
+        raise
+    catalog._bump(info['uid'], [file_tag], 'added', size, reservation)
+    logging.info('Added "%s" from the content of "%s" (%s)' % \
+                     (file_out, src_file, info['login_name']))
+    return file_manager._partial_reply(req, info, {'found': True, \
+                                                       'file_tag': file_tag})
+
+
+"""
+Large files can also be uploaded in chunks (by scripts, the upload page
+still sends the whole file at once), so that an interrupted upload can
+be resumed and chunks can be sent in parallel. The replies are JSON
+(see 'file_manager._partial_reply'):
+
+  action=chunk_init: takes the 'file_title', 'file_description',
+    'file_type', 'file_name' and the total 'file_size', reserves the
+    space (see 'catalog._reserve') and replies with an 'upload_id'.
+  action=chunk_put: takes the 'upload_id', the 'offset' of the chunk
+    within the file, its 'md5' and the 'chunk' itself (a file field of
+    at most 'max_chunk_size' bytes), and writes it in place.
+  action=chunk_status: takes the 'upload_id' and replies with the
+    'ranges' ([offset, length] pairs) received so far, and the 'offset'
+    up to which the file is complete (where to resume from).
+  action=chunk_finalize: takes the 'upload_id' (and optionally the
+    'md5' of the whole file), and once every byte has been received
+    turns the chunks into a -file/-file-id pair, replying with its
+    'file_tag'.
+
+The chunks are written straight into a sparse file under the 'uploads'
+directory of the user, next to a record of each acknowledged chunk
+(so parallel chunks need no locking). Each chunk keeps the space
+reserved (see 'catalog._touch'), and uploads left idle for longer than
+'quota_reservation_timeout' are removed, and their space released.
+The token is held over (as for downloads) between the chunked upload
+requests, since parallel chunks cannot each wait for a new one (see
+'per_request_token').
+"""
+
+
+def _chunk_dir(req, info):
+    """Find the directory of a chunked upload.
+
+       upload_dir = _chunk_dir(req, info)
+
+    Raises GetFileError if the 'upload_id' is malformed or unknown.
+    Returns a string.
+    """
+    import os
+    upload_id = req.form['upload_id'].value
+    if len(upload_id) != 64 or not upload_id.isalnum():
+        raise GetFileError('Invalid upload id "%s" (%s)' % \
+                               (upload_id, info['login_name']))
+    upload_dir = os.path.join(info['users_root_dir_'], str(info['uid']), \
+                                  'uploads', upload_id)
+    if not os.path.isdir(upload_dir):
+        raise GetFileError('Unknown upload id "%s" (%s)' % \
+                               (upload_id, info['login_name']))
+    return upload_dir
+
+
+def _chunk_ranges(upload_dir):
+    """List the chunks received so far.
+
+       (ranges, offset) = _chunk_ranges(upload_dir)
+
+    Returns a (list, int) tuple with the sorted [offset, length] pairs
+    and the offset up to which there are no gaps.
+    """
+    import os
+    ranges = sorted([[int(j) for j in i.split('-')] for i in \
+                         os.listdir(os.path.join(upload_dir, 'ranges'))])
+    offset = 0
+    for (start, length) in ranges:
+        if start > offset:
+            break
+        offset = max(offset, start + length)
+    return (ranges, offset)
+
+
+def _chunk_cleanup(info):
+    """Remove the chunked uploads which were never finished.
+
+       _chunk_cleanup(info)
+
+    Returns nothing.
+    """
+    import os
+    import time
+    import shutil
+    import logging
+    import manage_users
+    import catalog
+    uploads_dir = os.path.join(info['users_root_dir_'], str(info['uid']), \
+                                   'uploads')
+    if not os.path.isdir(uploads_dir):
+        return
+    for i in os.listdir(uploads_dir):
+        upload_dir = os.path.join(uploads_dir, i)
+        # The data file is touched by every chunk.
+        last = os.path.join(upload_dir, 'data')
+        if not os.path.isfile(last):
+            last = upload_dir
+        if time.time() - os.path.getmtime(last) < \
+                info['quota_reservation_timeout']:
+            continue
+        try:
+            state = manage_users._read_file(os.path.join(upload_dir, \
+                                                             'state'), \
+                                                lock=False)
+            catalog._release(info['uid'], state['reservation'])
+        except Exception as reason:
+            logging.warn('Unable to release stale upload "%s" because \
+"%s" (%s)' % (upload_dir, reason, info['login_name']))
+        shutil.rmtree(upload_dir, ignore_errors=True)
+        logging.info('Removed stale upload "%s" (%s)' % \
+                         (upload_dir, info['login_name']))
+    return
+
+
+def _chunk_init(req, info):
+    """Start a chunked upload.
+
+       return _chunk_init(req, info)
+
+    Returns a string (JSON).
+    """
+    import os
+    import time
+    import hashlib
+    import logging
+    import aux
+    import catalog
+    import file_manager
+    import manage_users
+    _chunk_cleanup(info)
+    try:
+        size = int(req.form['file_size'].value)
+        if size < 0:
+            raise ValueError
+    except:
+        return file_manager._partial_reply(req, info, \
+                                               {'error': 'Invalid file size'})
+    (reservation, size) = catalog._reserve(info['uid'], size, info['quota'])
+    if not reservation:
+        info['user_dir_size'] = catalog._usage(info['uid'])
+        error = aux._fill_str(info['quota_fit_blurb'], info)
+        return file_manager._partial_reply(req, info, {'error': error})
+    upload_id = hashlib.sha256(os.urandom(info['random_length'])).hexdigest()
+    upload_dir = os.path.join(info['users_root_dir_'], str(info['uid']), \
+                                  'uploads', upload_id)
+    state = {'file_size': size, 'reservation': reservation, \
+                 'started': time.time()}
+    for key in ['file_title', 'file_description', 'file_type', \
+                    'file_name']:
+        if key in req.form:
+            state[key] = req.form[key].value.decode('utf-8')
+        else:
+            state[key] = ''
+    try:
+        os.makedirs(os.path.join(upload_dir, 'ranges'), 0700)
+        # The data file is sparse until the chunks fill it in.
+        f = open(os.path.join(upload_dir, 'data'), 'wb')
+        f.truncate(size)
+        f.close()
+        manage_users._save_file(state, os.path.join(upload_dir, 'state'), \
+                                    unlock=False, backup=False)
+    except:
+        catalog._release(info['uid'], reservation)
+        raise
+    logging.info('Started chunked upload "%s" of %s bytes (%s)' % \
+                     (upload_id, size, info['login_name']))
+    return file_manager._partial_reply(req, info, {'upload_id': upload_id})
+
+
+def _chunk_put(req, info):
+    """Receive a chunk of a chunked upload.
+
+       return _chunk_put(req, info)
+
+    Returns a string (JSON).
+    """
+    import os
+    import hashlib
+    import catalog
+    import file_manager
+    import manage_users
+    upload_dir = _chunk_dir(req, info)
+    state = manage_users._read_file(os.path.join(upload_dir, 'state'), \
+                                        lock=False)
+    # The space stays reserved for as long as chunks keep coming.
+    if not catalog._touch(info['uid'], state['reservation']):
+        return file_manager._partial_reply(req, info, \
+                                               {'error': 'Upload expired'})
+    try:
+        offset = int(req.form['offset'].value)
+    except:
+        offset = -1
+    data = req.form['chunk'].file.read(info['max_chunk_size'] + 1)
+    if len(data) > info['max_chunk_size']:
+        error = 'Chunk larger than %s bytes' % info['max_chunk_size']
+    elif offset < 0 or offset + len(data) > state['file_size']:
+        error = 'Chunk outside of the file'
+    elif 'md5' not in req.form or \
+            hashlib.md5(data).hexdigest() != req.form['md5'].value:
+        error = 'Chunk checksum mismatch'
+    else:
+        error = ''
+    if error:
+        return file_manager._partial_reply(req, info, {'error': error})
+    f = open(os.path.join(upload_dir, 'data'), 'r+b')
+    try:
+        f.seek(offset)
+        f.write(data)
+    finally:
+        f.close()
+    # Only chunks which made it to disk are acknowledged.
+    open(os.path.join(upload_dir, 'ranges', \
+                          '%s-%s' % (offset, len(data))), 'wb').close()
+    return file_manager._partial_reply(req, info, {'offset': offset, \
+                                                       'length': len(data)})
+
+
+def _chunk_status(req, info):
+    """Report on the chunks received so far.
+
+       return _chunk_status(req, info)
+
+    Returns a string (JSON).
+    """
+    import os
+    import file_manager
+    import manage_users
+    upload_dir = _chunk_dir(req, info)
+    state = manage_users._read_file(os.path.join(upload_dir, 'state'), \
+                                        lock=False)
+    (ranges, offset) = _chunk_ranges(upload_dir)
+    return file_manager._partial_reply(req, info, \
+                                           {'file_size': state['file_size'], \
+                                                'ranges': ranges, \
+                                                'offset': offset})
+
+
+def _chunk_finalize(req, info):
+    """Turn a complete chunked upload into a file.
+
+       return _chunk_finalize(req, info)
+
+    Returns a string (JSON).
+    """
+    import os
+    import shutil
+    import logging
+    import catalog
+    import file_manager
+    import manage_users
+    upload_dir = _chunk_dir(req, info)
+    state = manage_users._read_file(os.path.join(upload_dir, 'state'), \
+                                        lock=False)
+    (ranges, offset) = _chunk_ranges(upload_dir)
+    if offset < state['file_size']:
+        return file_manager._partial_reply(req, info, \
+                                               {'error': 'Upload incomplete', \
+                                                    'offset': offset})
+    # Without its reservation the file could take space others now have.
+    if not catalog._touch(info['uid'], state['reservation']):
+        return file_manager._partial_reply(req, info, \
+                                               {'error': 'Upload expired'})
+    data_file = os.path.join(upload_dir, 'data')
+    # The chunks may have come in any order, so the digests are only
+    # taken once they are all in.
+    hasher = _Hasher(_digest_names(info), info['threaded_hashing'])
+    head = ''
+    f = open(data_file, 'rb', info['chunk_size'])
+    try:
+        for chunk in _fbuffer(f, info['chunk_size']):
+            if not head:
+                head = chunk
+            hasher.update(chunk)
+    finally:
+        f.close()
+        digests = hasher.hexdigests()
+    if 'md5' in req.form and digests['md5'] != req.form['md5'].value:
+        return file_manager._partial_reply(req, info, \
+                                               {'error': \
+                                                    'File checksum mismatch'})
+    file_tag = _new_file_tag(info)
+    file_out = os.path.join(info['users_root_dir_'], str(info['uid']), \
+                                file_tag)
+    os.rename(data_file, file_out)
+    os.chmod(file_out, 0600)
+    try:
+        _save_id_file(file_out, state, digests, info, head)
+    except:
+        catalog._release(info['uid'], state['reservation'])
+        shutil.rmtree(upload_dir, ignore_errors=True)
+        raise
+    catalog._bump(info['uid'], [file_tag], 'added', \
+                      state['file_size'], state['reservation'])
+    shutil.rmtree(upload_dir, ignore_errors=True)
+    logging.info('Finished chunked upload "%s" into "%s" (%s)' % \
+                     (os.path.basename(upload_dir), file_out, \
+                          info['login_name']))
+    return file_manager._partial_reply(req, info, {'file_tag': file_tag})
+
+
 def _check_quota(req, up_type, info):
     """Check the user's quota. 'up_type' is a string such as 'upload'
     or 'copy', depending on how the file is being added. Only '-file'
@@ -240,30 +1225,44 @@ def _check_quota(req, up_type, info):
 
     Returns an (int, str) tuple with the user's space usage and
     an empty string if underquota, the number -1 and a "you are
-    over quota" page (as a string) if overquota. Note that the quota
-    doesn't impede a user from going over it, it just disallows
-    adding files after it has been exceeded. Worst case scenario
-    uses up approximately 'quota + max upload size'.
+    over quota" page (as a string) if overquota. This only turns users
+    away once they are out of space: whether a file fits in the space
+    left is checked as it is added (see 'catalog._reserve').
     """
-    import aux
     import logging
-    user_dir_size = aux._get_dir_size(info)
+    import catalog
+    user_dir_size = catalog._usage(info['uid'])
     logging.debug('Space usage: %s/%s (%s)' % \
                       (user_dir_size, info['quota'], info['login_name']))
     if user_dir_size >= info['quota']:
-        info['user_dir_size'] = user_dir_size
-        info['details'] = aux._fill_str(info['quota_limit_blurb'], info)
-        info['class'] = 'fail'
-        info['status_button_1'] = aux._go_back_button(req, info['token'])
-        info['status_button_2'] = ''
-        logging.info('File %s forbidden due to quota limits (%s)' % \
-                         (up_type, info['login_name']))
-        info['title'] = up_type.capitalize()
-        return (-1, aux._fill_page(info['status_page_'], info))
+        return (-1, _over_quota_page(req, up_type, info, \
+                                         info['quota_limit_blurb']))
     else:
         return (user_dir_size, '')
 
 
+def _over_quota_page(req, up_type, info, blurb):
+    """Make the page turning away a file for lack of quota.
+
+       page = _over_quota_page(req, up_type, info, blurb)
+
+    The 'blurb' is either 'quota_limit_blurb' or 'quota_fit_blurb'.
+    Returns a string (page).
+    """
+    import aux
+    import logging
+    import catalog
+    info['user_dir_size'] = catalog._usage(info['uid'])
+    info['details'] = aux._fill_str(blurb, info)
+    info['class'] = 'fail'
+    info['status_button_1'] = aux._go_back_button(req, info['token'])
+    info['status_button_2'] = ''
+    logging.info('File %s forbidden due to quota limits (%s)' % \
+                     (up_type, info['login_name']))
+    info['title'] = up_type.capitalize()
+    return aux._fill_page(info['status_page_'], info)
+
+
 def process(req):
     """Process the upload page.
 
@@ -369,8 +1368,13 @@ large (max size = %s bytes).' % max_size
         info['details'] = 'You cannot upload over an insecure connection.'
         logging.info(info['details'])
         return _fill_page(info['error_page_'], info)
+    # The chunks of a chunked upload share the token they started with
+    # (see '_chunk_init').
+    chunk_actions = ['chunk_init', 'chunk_put', 'chunk_status', \
+                         'chunk_finalize']
+    chunked = 'action' in req.form and req.form['action'] in chunk_actions
     try:
-        session = _is_session(req, required=True)
+        session = _is_session(req, required=True, holdover=chunked)
         info.update(session)
         if session['token']:
             profile = _account_info(info['login_name'], 'profile')
@@ -380,6 +1384,29 @@ large (max size = %s bytes).' % max_size
         info['details'] = '[SYS] Unable to verify session [%s].' % \
             info['error_blurb_']
         return _fill_page(info['error_page_'], info)
+    if chunked:
+        try:
+            if req.form['action'] == 'chunk_init':
+                return _chunk_init(req, info)
+            elif req.form['action'] == 'chunk_put':
+                return _chunk_put(req, info)
+            elif req.form['action'] == 'chunk_status':
+                return _chunk_status(req, info)
+            else:
+                return _chunk_finalize(req, info)
+        except Exception as reason:
+            logging.critical(reason)
+            info['details'] = '[SYS] Error uploading file [%s].' % \
+                info['error_blurb_']
+            return _fill_page(info['error_page_'], info)
+    if 'action' in req.form and req.form['action'] == 'upload_by_hash':
+        try:
+            return _upload_by_hash(req, info)
+        except Exception as reason:
+            logging.critical(reason)
+            info['details'] = '[SYS] Error uploading file [%s].' % \
+                info['error_blurb_']
+            return _fill_page(info['error_page_'], info)
     info['main_header'] = _make_header(info)
     # User cannot upload if over-quota.
     try:
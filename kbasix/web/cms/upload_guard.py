@@ -0,0 +1,261 @@
+"""
+The upload guard module for the KBasix CMS.
+Created by: Pamela Brittain
+            James Colliander
+            Marco De la Cruz-Heredia
+            Emile LeBlanc
+Coded by: Marco De la Cruz-Heredia (marco@math.utoronto.ca)
+
+Copyright (c) 2012, Department of Mathematics, University of Toronto
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice,
+   this list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+POSSIBILITY OF SUCH DAMAGE.
+"""
+
+_VERSION = 0.10
+
+
+"""
+By the time 'upload.process' runs, mod_python has already received the
+whole request body and spooled the file to disk, so an upload which
+cannot fit in the user's quota is only refused after the fact. This
+fixup handler runs before the body is read, and turns such uploads away
+based on their declared size (the Content-Length header). In .htaccess:
+
+  <Files "upload.py">
+    PythonFixupHandler upload_guard
+  </Files>
+
+Since the request also carries the rest of the upload form, it may be
+up to 'form_overhead' bytes larger than the space left (the writing of
+the file stops anyway once it no longer fits, see
+'upload._write_stream'). Uploads larger than 'size_limit_' are already
+turned away by Apache itself ("LimitRequestBody" is also checked
+against the Content-Length before the body is read). The body holds
+the session token too, so it is also put in the query string of the
+upload form's action (see 'upload.html') and checked here before the
+quota is looked at: otherwise anyone could find out how much space any
+user has left by trying different Content-Length values. Everything is
+checked again by 'upload.process'.
+
+Uploads which are let through are then parsed here (the publisher uses
+'req.form' if it is already set), so that their files are spooled into
+'spool_dir_' rather than to /tmp. The spool is hashed as it is written,
+and being on the same filesystem it is then just renamed into the
+directory of the user (see 'upload._place'), once 'upload.process' has
+checked the session: each byte uploaded is written once instead of
+twice. The spool is never put in a user's directory before then. A
+spool not placed is removed at
+the end of the request (or, if the request died, by a later one).
+"""
+
+
+class _Spool(object):
+    """A spooled upload file, hashed as mod_python writes it.
+
+       spool = _Spool(spool_dir, info)
+
+    It behaves as the file it wraps (which mod_python reads back as the
+    field value), plus 'place'.
+    """
+
+    def __init__(self, spool_dir, info):
+        import os
+        import tempfile
+        from upload import _Hasher, _digest_names
+        (fd, self.path) = tempfile.mkstemp(prefix='spool-', dir=spool_dir)
+        self.file = os.fdopen(fd, 'w+b')
+        self.hasher = _Hasher(_digest_names(info))
+        self.chunk_size = info['chunk_size']
+        self.written = 0
+        self.head = ''
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+    def write(self, data):
+        # The first chunk is kept for 'upload._magic_type'.
+        if len(self.head) < self.chunk_size:
+            self.head += data[:self.chunk_size - len(self.head)]
+        self.written += len(data)
+        self.hasher.update(data)
+        self.file.write(data)
+
+    def place(self, file_out):
+        """Move the spool to its final location.
+
+           (written, digests, head) = spool.place(file_out)
+
+        Returns an (int, dict, str) tuple, as 'upload._write_stream'.
+        """
+        import os
+        self.file.flush()
+        os.rename(self.path, file_out)
+        self.path = file_out
+        return (self.written, self.hasher.hexdigests(), self.head)
+
+
+def _unspool(spools):
+    """Remove the spool files which were not put in place.
+
+       _unspool(spools)
+
+    Returns nothing.
+    """
+    import os
+    for spool in spools:
+        spool.file.close()
+        if os.path.basename(spool.path).startswith('spool-') and \
+                os.path.isfile(spool.path):
+            os.remove(spool.path)
+    return
+
+
+def _spool_form(req, info):
+    """Parse an upload, spooling its files into 'spool_dir_'.
+
+       _spool_form(req, info)
+
+    Returns nothing ('req.form' is set).
+    """
+    import os
+    import time
+    from mod_python import util
+    spool_dir = info['spool_dir_']
+    if not os.path.isdir(spool_dir):
+        try:
+            os.mkdir(spool_dir, 0700)
+        except OSError:
+            # Another process got there first.
+            pass
+    # Left over by requests which died.
+    for i in os.listdir(spool_dir):
+        spool_file = os.path.join(spool_dir, i)
+        try:
+            if time.time() - os.path.getmtime(spool_file) >= \
+                    info['quota_reservation_timeout']:
+                os.remove(spool_file)
+        except OSError:
+            pass
+    spools = []
+    def spool(filename):
+        spools.append(_Spool(spool_dir, info))
+        return spools[-1]
+    req.register_cleanup(_unspool, spools)
+    req.form = util.FieldStorage(req, keep_blank_values=1, \
+                                     file_callback=spool)
+    return
+
+
+def _session(req):
+    """Check the session token in the query string of an upload.
+
+       session = _session(req)
+
+    Returns a dictionary (see 'manage_kbasix._is_session'), whose
+    'token' is empty if the session isn't valid.
+    """
+    from mod_python import util
+    from manage_kbasix import _is_session
+    token = util.parse_qs(req.args)['token'][0]
+    # The body hasn't been read, and '_is_session' looks for the token in
+    # 'req.form', so it is given one just for the check (which must not
+    # be left set, or the publisher would take it as the whole form).
+    req.form = {'token': token}
+    try:
+        # The token is not renewed here, the one in the body is still
+        # needed by 'upload.process'.
+        return _is_session(req, required=False, holdover=True)
+    finally:
+        del req.form
+
+
+def _remaining_quota(uid):
+    """Find how much space a user has left.
+
+       remaining = _remaining_quota(uid)
+
+    Returns an int (bytes), None if the user doesn't exist.
+    """
+    import catalog
+    import manage_kbasix
+    import manage_users
+    user_info = manage_users._info(uid)
+    if not user_info:
+        return None
+    quota = manage_kbasix._account_info(user_info['login_name'], \
+                                            'profile')['quota']
+    return quota - catalog._usage(uid)
+
+
+def fixuphandler(req):
+    """Turn away uploads which will not fit in the user's quota.
+
+       status = fixuphandler(req)
+
+    Returns apache.DONE if the upload was turned away (with a small
+    error page), apache.OK otherwise (having spooled it, see
+    '_spool_form').
+    """
+    from mod_python import apache, util
+    from aux import _fill_page, _bytes_string
+    from defs import kbasix, upload
+    info = {}
+    info.update(kbasix)
+    info.update(upload)
+    import logging
+    logging.basicConfig(level = getattr(logging, \
+                                            info['log_level_'].upper()), \
+                            filename = info['log_file_'], \
+                            datefmt = info['log_dateformat_'], \
+                            format = info['log_format_'])
+    if req.method != 'POST' or not req.args:
+        return apache.OK
+    # Without a valid session the upload is left to 'upload.process'
+    # (which will turn it away), and the quota isn't even looked at.
+    try:
+        size = int(req.headers_in['Content-Length'])
+        session = _session(req)
+        if not session['token']:
+            return apache.OK
+        remaining = _remaining_quota(session['uid'])
+    except:
+        return apache.OK
+    if remaining is None:
+        return apache.OK
+    # The request also carries the rest of the form, which isn't charged.
+    if size - info['form_overhead'] <= remaining:
+        content_type = req.headers_in.get('Content-Type', '')
+        if info['spool_uploads'] and \
+                content_type.startswith('multipart/form-data'):
+            _spool_form(req, info)
+        return apache.OK
+    logging.info('Upload of %s bytes turned away with %s bytes of quota \
+left (%s)' % (size, remaining, session['login_name']))
+    info['details'] = 'The file you are trying to upload does not fit in \
+your remaining quota (%s left).' % _bytes_string(max(0, remaining))
+    # A 413 status makes Apache close the connection instead of reading
+    # (and discarding) the rest of the body.
+    req.status = apache.HTTP_REQUEST_ENTITY_TOO_LARGE
+    req.content_type = 'text/html'
+    req.write(_fill_page(info['error_page_'], info))
+    return apache.DONE